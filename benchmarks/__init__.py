@@ -0,0 +1 @@
+"""Benchmarks for the faucet hot paths (not run as part of the test suite)."""
@@ -0,0 +1,117 @@
+"""Benchmark the selection of winners in random distribution mode.
+
+The previous selection (random.choice + list.remove, quadratic) is timed on
+in-memory lists up to a given size, while the current one (random.sample) is
+timed both in memory and end-to-end on a SQLite database with all requests
+waiting, including the bulk promotion and the "unmet" update.
+
+Usage:
+    poetry run python -m benchmarks.random_selection [--waiting N] [--old-max N]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from flask import Flask
+
+from faucet_rgb.database import Request, db
+
+ASSET_ID = "rgb:asset-0"
+CHUNK_SIZE = 100_000
+
+
+def _select_old(waiting, balance, rng):
+    reqs = list(waiting)
+    chosen = []
+    while balance > 0 and reqs:
+        req = rng.choice(reqs)
+        chosen.append(req)
+        reqs.remove(req)
+        balance -= 1
+    return chosen
+
+
+def _select_new(waiting, balance, rng):
+    return rng.sample(waiting, min(max(balance, 0), len(waiting)))
+
+
+def _time_in_memory(select_func, waiting, balance, seed):
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    select_func(list(range(waiting)), balance, rng)
+    return time.perf_counter() - start
+
+
+def _time_db(waiting, balance, seed):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = Flask(__name__)
+        db_path = os.path.join(tmp_dir, "bench.sqlite3")
+        app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
+        db.init_app(app)
+        with app.app_context():
+            db.create_all()
+            raw = db.session.connection().connection.driver_connection
+            now = round(time.time())
+            for start in range(0, waiting, CHUNK_SIZE):
+                raw.executemany(
+                    "INSERT INTO request (timestamp, status, wallet_id, recipient_id, invoice, "
+                    "asset_group, asset_id, amount) VALUES (?, 25, ?, ?, ?, 'group', ?, 1)",
+                    [
+                        (now, f"{i:064x}", f"utxob:{i}", f"rgb:~/~/~/bc:utxob:{i}", ASSET_ID)
+                        for i in range(start, min(start + CHUNK_SIZE, waiting))
+                    ],
+                )
+            db.session.commit()  # pylint: disable=no-member
+
+            # same steps as tasks.random_distribution
+            rng = random.Random(seed)
+            start = time.perf_counter()
+            waiting_idxs = [
+                row.idx
+                for row in db.session.query(Request.idx)  # pylint: disable=no-member
+                .filter_by(asset_id=ASSET_ID, status=25)
+                .order_by(Request.idx)
+            ]
+            chosen_idxs = _select_new(waiting_idxs, balance, rng)
+            Request.update_status(chosen_idxs, 25, 20)
+            Request.query.filter_by(asset_id=ASSET_ID, status=25).update({"status": 45})
+            db.session.commit()  # pylint: disable=no-member
+            elapsed = time.perf_counter() - start
+            db.engine.dispose()
+    return elapsed
+
+
+def entrypoint():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description="Random distribution selection benchmark.")
+    parser.add_argument("--waiting", type=int, default=1_000_000, help="waiting requests")
+    parser.add_argument(
+        "--balance", type=int, default=None, help="asset balance (default: half the requests)"
+    )
+    parser.add_argument(
+        "--old-max", type=int, default=50_000, help="max waiting requests for the old selection"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    sizes = [n for n in (1_000, 10_000, 100_000, 1_000_000) if n < args.waiting]
+    sizes.append(args.waiting)
+    print(f"{'waiting':>10} {'old (s)':>10} {'new (s)':>10}")
+    for size in sizes:
+        balance = size // 2 if args.balance is None else args.balance
+        old = "-"
+        if size <= args.old_max:
+            old = f"{_time_in_memory(_select_old, size, balance, args.seed):.3f}"
+        new = _time_in_memory(_select_new, size, balance, args.seed)
+        print(f"{size:>10} {old:>10} {new:>10.3f}")
+
+    balance = args.waiting // 2 if args.balance is None else args.balance
+    elapsed = _time_db(args.waiting, balance, args.seed)
+    print(f"\nend-to-end on SQLite ({args.waiting} waiting, {balance} chosen): {elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    entrypoint()
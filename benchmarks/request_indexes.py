@@ -0,0 +1,135 @@
+"""Benchmark latency of the hot request table queries with and without indexes.
+
+The request table is filled with synthetic rows (mostly served requests, as on
+a long-running faucet) and each query shape is timed before and after creating
+the indexes declared on the Request model.
+
+Usage:
+    poetry run python -m benchmarks.request_indexes [--rows N [N ...]] [--repeat R]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine, text
+
+from faucet_rgb.database import Request
+
+GROUPS = [f"group_{i}" for i in range(5)]
+ASSET_IDS = [f"rgb:asset-{i}" for i in range(10)]
+# mostly served requests, with a few in the other statuses
+STATUS_WEIGHTS = {10: 1, 20: 1, 25: 1, 40: 95, 45: 2}
+CHUNK_SIZE = 100_000
+
+QUERIES = {
+    "eligibility (wallet_id, asset_group)": (
+        "SELECT COUNT(*) FROM request WHERE wallet_id = :wallet_id AND asset_group = :asset_group"
+    ),
+    "pending (status, asset_id, idx)": (
+        "SELECT idx FROM request WHERE status = 20 AND asset_id = :asset_id ORDER BY idx LIMIT 1"
+    ),
+    "stale new (status, timestamp)": (
+        "SELECT COUNT(*) FROM request WHERE status = 10 AND timestamp < :timestamp"
+    ),
+}
+
+
+def _fill(engine, rows, rng):
+    now = round(time.time())
+    statuses = list(STATUS_WEIGHTS)
+    weights = list(STATUS_WEIGHTS.values())
+    wallet_ids = []
+    with engine.begin() as conn:
+        raw = conn.connection.driver_connection
+        for start in range(0, rows, CHUNK_SIZE):
+            batch = []
+            for idx in range(start, min(start + CHUNK_SIZE, rows)):
+                wallet_id = f"{rng.getrandbits(256):064x}"
+                if idx % 1000 == 0:
+                    wallet_ids.append(wallet_id)
+                batch.append(
+                    (
+                        now - rows + idx,
+                        rng.choices(statuses, weights)[0],
+                        wallet_id,
+                        f"utxob:{idx}",
+                        f"rgb:~/~/~/bc:utxob:{idx}",
+                        rng.choice(GROUPS),
+                        rng.choice(ASSET_IDS),
+                        1,
+                    )
+                )
+            raw.executemany(
+                "INSERT INTO request (timestamp, status, wallet_id, recipient_id, invoice, "
+                "asset_group, asset_id, amount) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                batch,
+            )
+    return wallet_ids, now
+
+
+def _time_queries(engine, wallet_ids, now, repeat, rng):
+    results = {}
+    with engine.connect() as conn:
+        for name, query in QUERIES.items():
+            timings = []
+            for _ in range(repeat):
+                params = {
+                    "wallet_id": rng.choice(wallet_ids),
+                    "asset_group": rng.choice(GROUPS),
+                    "asset_id": rng.choice(ASSET_IDS),
+                    "timestamp": now - 120,
+                }
+                start = time.perf_counter()
+                conn.execute(text(query), params).all()
+                timings.append(time.perf_counter() - start)
+            results[name] = statistics.median(timings) * 1000
+    return results
+
+
+def run(rows, repeat, seed=0):
+    """Run the benchmark for the given number of rows, return timings in ms."""
+    rng = random.Random(seed)
+    table = Request.__table__
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'bench.sqlite3')}")
+        table.create(engine)
+        with engine.begin() as conn:
+            for index in table.indexes:
+                index.drop(conn)
+        wallet_ids, now = _fill(engine, rows, rng)
+        no_index = _time_queries(engine, wallet_ids, now, repeat, rng)
+        with engine.begin() as conn:
+            for index in table.indexes:
+                index.create(conn)
+            conn.execute(text("ANALYZE"))
+        with_index = _time_queries(engine, wallet_ids, now, repeat, rng)
+        engine.dispose()
+    return no_index, with_index
+
+
+def entrypoint():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description="Request table index benchmark.")
+    parser.add_argument(
+        "--rows",
+        type=int,
+        nargs="+",
+        default=[10_000, 1_000_000, 10_000_000],
+        help="table sizes to benchmark",
+    )
+    parser.add_argument("--repeat", type=int, default=20, help="runs per query")
+    args = parser.parse_args()
+
+    print(f"{'rows':>10}  {'query':<38} {'no index (ms)':>14} {'index (ms)':>11}")
+    for rows in args.rows:
+        no_index, with_index = run(rows, args.repeat)
+        for name in QUERIES:
+            print(f"{rows:>10}  {name:<38} {no_index[name]:>14.3f} {with_index[name]:>11.3f}")
+
+
+if __name__ == "__main__":
+    entrypoint()
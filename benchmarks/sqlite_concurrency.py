@@ -0,0 +1,187 @@
+"""Benchmark request latency while the scheduler commits a batch, per SQLite setup.
+
+Client threads repeatedly run the database work of `/receive/asset`
+(eligibility check and request insert) and of `/receive/config` (eligibility
+check only), while a writer thread keeps adding batches of pending requests
+and marking them as processing and then served, as the scheduler does when
+sending. Latency percentiles are reported for the rollback journal (SQLite
+defaults) and for the configured pragmas (WAL).
+
+Usage:
+    poetry run python -m benchmarks.sqlite_concurrency [--batch N] [--clients N] [--duration S]
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from flask import Flask
+from sqlalchemy import insert
+
+from faucet_rgb.database import Request, configure_sqlite, db
+from faucet_rgb.receive import _get_request_eligibility, _request_rgb_asset_core
+from faucet_rgb.settings import Config, compile_assets
+from faucet_rgb.utils import get_logger
+
+ASSET_ID = "rgb:asset-0"
+GROUP = "group"
+PREFILL_ROWS = 100_000
+SETUPS = {
+    "rollback journal": {
+        "SQLITE_BUSY_TIMEOUT": 30000,
+        "SQLITE_JOURNAL_MODE": None,
+        "SQLITE_SYNCHRONOUS": None,
+        "SQLITE_MMAP_SIZE": None,
+        "SQLITE_CACHE_SIZE": None,
+    },
+    "configured (WAL)": {"SQLITE_BUSY_TIMEOUT": 30000},
+}
+
+
+def _create_app(db_path, pragmas):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config.update(pragmas)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{db_path}"
+    app.config["ASSETS"] = {
+        GROUP: {
+            "label": "benchmark",
+            "distribution": {"mode": 1},
+            "assets": [{"asset_id": ASSET_ID, "amount": 1}],
+        }
+    }
+    app.config["ASSET_GROUPS"] = compile_assets(app.config)
+    app.config["ASSET_METADATA_CACHE"] = {
+        ASSET_ID: {"schema": "NIA", "name": "asset", "precision": 0, "ticker": "ASSET"}
+    }
+    db.init_app(app)
+    with app.app_context():
+        configure_sqlite(db.engine, app.config)
+        db.create_all()
+        raw = db.session.connection().connection.driver_connection
+        now = round(time.time())
+        raw.executemany(
+            "INSERT INTO request (timestamp, status, wallet_id, recipient_id, invoice, "
+            "asset_group, asset_id, amount) VALUES (?, 40, ?, ?, ?, ?, ?, 1)",
+            [
+                (now, f"{i:064x}", f"utxob:{i}", f"rgb:~/~/~/bc:utxob:{i}", GROUP, ASSET_ID)
+                for i in range(PREFILL_ROWS)
+            ],
+        )
+        db.session.commit()  # pylint: disable=no-member
+    return app
+
+
+def _writer(app, batch, send_time, stop):
+    with app.app_context():
+        added = 0
+        while not stop.is_set():
+            # pylint: disable=no-member
+            now = round(time.time())
+            reqs = [
+                {
+                    "timestamp": now,
+                    "status": 20,
+                    "wallet_id": f"w{added + i:063x}",
+                    "recipient_id": f"utxob:w{added + i}",
+                    "invoice": "rgb:~/~/~/bc:utxob:w",
+                    "asset_group": GROUP,
+                    "asset_id": ASSET_ID,
+                    "amount": 1,
+                }
+                for i in range(batch)
+            ]
+            added += batch
+            db.session.execute(insert(Request), reqs)
+            db.session.commit()
+            idxs = [
+                row.idx for row in db.session.query(Request.idx).filter_by(status=20).limit(batch)
+            ]
+            # same steps as scheduler._try_send, with the wallet send simulated
+            Request.update_status(idxs, 20, 30)
+            db.session.commit()
+            time.sleep(send_time)
+            Request.update_status(idxs, 30, 40)
+            db.session.commit()
+            # pylint: enable=no-member
+
+
+def _client(app, client_id, stop, latencies):
+    logger = get_logger(__name__)
+    recipient_data = {
+        "recipient_id": f"utxob:c{client_id}",
+        "invoice": "rgb:~/~/~/bc:utxob:c",
+        "witness": False,
+        "transport_endpoints": [],
+    }
+    asset = app.config["ASSET_GROUPS"][GROUP].assets[0]
+    count = 0
+    with app.app_context():
+        while not stop.is_set():
+            wallet_id = f"c{client_id:03x}{count:060x}"
+            count += 1
+            start = time.perf_counter()
+            _get_request_eligibility(wallet_id, [GROUP])
+            latencies["config"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            _get_request_eligibility(wallet_id, [GROUP])
+            _request_rgb_asset_core(wallet_id, recipient_data, GROUP, asset, logger)
+            latencies["asset"].append(time.perf_counter() - start)
+
+
+def _percentiles(values):
+    cuts = statistics.quantiles(values, n=100)
+    return (cuts[49] * 1000, cuts[98] * 1000, max(values) * 1000)
+
+
+def _run(setup, args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = _create_app(os.path.join(tmp_dir, "bench.sqlite3"), SETUPS[setup])
+        stop = threading.Event()
+        latencies = {"config": [], "asset": []}
+        threads = [threading.Thread(target=_writer, args=(app, args.batch, args.send_time, stop))]
+        threads += [
+            threading.Thread(target=_client, args=(app, i, stop, latencies))
+            for i in range(args.clients)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        with app.app_context():
+            db.engine.dispose()
+    for endpoint, values in latencies.items():
+        p50, p99, worst = _percentiles(values)
+        print(
+            f"{setup:>18} {'/receive/' + endpoint:>16} {len(values):>8} "
+            f"{p50:>9.2f} {p99:>9.2f} {worst:>9.2f}"
+        )
+
+
+def entrypoint():
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description="SQLite concurrency benchmark.")
+    parser.add_argument("--batch", type=int, default=1000, help="recipients per batch")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent client threads")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per setup")
+    parser.add_argument(
+        "--send-time", type=float, default=0.5, help="simulated wallet send time, in seconds"
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{'setup':>18} {'endpoint':>16} {'requests':>8} "
+        f"{'p50 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}"
+    )
+    for setup in SETUPS:
+        _run(setup, args)
+
+
+if __name__ == "__main__":
+    entrypoint()
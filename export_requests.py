@@ -0,0 +1,53 @@
+"""Module to export the faucet request history with no running faucet."""
+
+import argparse
+import sys
+
+from faucet_rgb import export, settings
+
+
+def entrypoint():
+    """Poetry script entrypoint."""
+    parser = argparse.ArgumentParser(description="Export requests.")
+    parser.add_argument("output", help='output file path, "-" for stdout')
+    parser.add_argument(
+        "--format",
+        choices=export.EXPORT_FORMATS,
+        default="csv",
+        help="output format (parquet requires pyarrow)",
+    )
+    parser.add_argument("--status", type=int, help="only export requests in status")
+    parser.add_argument("--asset_group", help="only export requests for asset group")
+    parser.add_argument("--asset_id", help="only export requests for asset ID")
+    parser.add_argument("--since", type=int, help="only export requests from timestamp (included)")
+    parser.add_argument("--until", type=int, help="only export requests up to timestamp (excluded)")
+    parser.add_argument("--archived", action="store_true", help="export archived requests")
+    args = parser.parse_args()
+
+    if args.format == "parquet" and export.pyarrow is None:
+        print("parquet export requires the pyarrow package")
+        sys.exit(1)
+
+    app = settings.get_app(__name__)
+    settings.check_database_config(app)
+    engine = export.create_readonly_engine(app.config["SQLALCHEMY_DATABASE_URI"])
+    filters = {
+        "status": args.status,
+        "asset_group": args.asset_group,
+        "asset_id": args.asset_id,
+        "since": args.since,
+        "until": args.until,
+    }
+    query = export.get_export_query(filters, args.archived)
+
+    if args.output == "-":
+        out = sys.stdout.buffer
+    else:
+        out = open(args.output, "wb")  # pylint: disable=consider-using-with
+    try:
+        for data in export.iter_export(engine, query, args.format):
+            out.write(data)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+        engine.dispose()
@@ -1,6 +1,5 @@
 """Faucet Flask app initialization and configuration."""
 
-import itertools
 import os
 import sys
 import uuid
@@ -9,39 +8,48 @@ from logging.config import dictConfig
 from flask import g, request
 from flask_apscheduler import STATE_STOPPED
 from flask_migrate import upgrade
-from sqlalchemy import and_
+from sqlalchemy import case, func, insert, select, union_all
+from sqlalchemy.exc import IntegrityError
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from . import control, receive, reserve, tasks
-from .database import Request, db, migrate
+from .database import (
+    MigrationEntitlement,
+    Request,
+    RequestArchive,
+    configure_sqlite,
+    db,
+    migrate,
+)
 from .scheduler import scheduler
 from .settings import LOGGING, check_config, get_app
+from .utils import update_asset_cache
 from .utils.wallet import get_sha256_hex, init_wallet, wallet_data_from_config
 
 
-def print_assets_and_quit(assets, asset_id):
-    """Print provided assets and asset ID, then terminate the process."""
+def print_assets_and_quit(asset_cache, asset_id):
+    """Print cached assets and provided asset ID, then terminate the process."""
     print("List of available NIA assets:")
-    for asset in assets.nia:
-        print(
-            " -",
-            asset.asset_id,
-            asset.ticker,
-            asset.name,
-            asset.precision,
-            asset.balance,
-        )
+    for cached_id, asset in asset_cache.items():
+        if asset["schema"] == "NIA":
+            print(
+                " -",
+                cached_id,
+                asset["ticker"],
+                asset["name"],
+                asset["precision"],
+            )
     print("List of available CFA assets:")
-    for asset in assets.cfa:
-        print(
-            " -",
-            asset.asset_id,
-            asset.name,
-            asset.description,
-            asset.precision,
-            asset.data_paths,
-            asset.balance,
-        )
+    for cached_id, asset in asset_cache.items():
+        if asset["schema"] == "CFA":
+            print(
+                " -",
+                cached_id,
+                asset["name"],
+                asset.get("description"),
+                asset["precision"],
+                asset.get("data_paths", []),
+            )
     print(f'Cannot proceed: configured asset with id "{asset_id}" not found')
     sys.exit(1)
 
@@ -84,37 +92,57 @@ def validate_migration_map(app):
 
 
 def _get_group_and_asset_from_id(app, asset_id):
-    for group_name, group_data in app.config["ASSETS"].items():
-        for asset in group_data["assets"]:
+    for group_name, group in app.config["ASSET_GROUPS"].items():
+        for asset in group.assets:
             if asset["asset_id"] == asset_id:
                 return (group_name, asset)
     raise KeyError(asset_id)
 
 
 def _get_all_requests_waiting_for_migration(rev_mig_map):
-    """Gather all requests which haven't completed migration."""
-    reqs = (
-        Request.query.filter(Request.status == 40)  # consider only "served" status
-        .order_by(Request.wallet_id)
-        .all()
+    """Gather all requests which haven't completed migration.
+
+    A request (possibly archived) is waiting for migration if it served an old
+    asset (from a wallet with an xPub wallet ID) and the same wallet has not
+    been served the corresponding new asset yet. Such requests are selected by
+    a single query (anti-join), returning (wallet_id, asset_id) rows as a
+    stream.
+    """
+    old_req = _get_request_history().subquery("old_req")
+    new_req = _get_request_history().subquery("new_req")
+    migrated = select(new_req.c.wallet_id).where(
+        new_req.c.wallet_id == old_req.c.wallet_id,
+        new_req.c.status == 40,
+        new_req.c.asset_id == case(rev_mig_map, value=old_req.c.asset_id),
+    )
+    return (
+        db.session.query(old_req.c.wallet_id, old_req.c.asset_id)  # pylint: disable=no-member
+        .filter(
+            old_req.c.status == 40,  # consider only "served" status
+            old_req.c.asset_id.in_(rev_mig_map.keys()),
+            func.length(old_req.c.wallet_id) > 64,
+            ~migrated.exists(),
+        )
+        .yield_per(1000)
+    )
+
+
+def _get_request_history():
+    """Return a query for all requests, including archived ones."""
+    return union_all(
+        select(Request.wallet_id, Request.asset_id, Request.status),
+        select(RequestArchive.wallet_id, RequestArchive.asset_id, RequestArchive.status),
     )
-    reqs_waiting_for_migration = []
-    for _, same_wallet_requests in itertools.groupby(reqs, lambda r: r.wallet_id):
-        it1, it2 = itertools.tee(same_wallet_requests, 2)
-        for req in it1:
-            new_asset_id = rev_mig_map.get(req.asset_id)
-            if new_asset_id is None:
-                continue
-            wallet_migration_complete = any(r.asset_id == new_asset_id for r in it2)
-            if not wallet_migration_complete:
-                reqs_waiting_for_migration.append(req)
-    return reqs_waiting_for_migration
-
-
-def create_user_migration_cache(app):
-    """Create `ASSET_MIGRATION_CACHE`, which is used later to perform migration.
-
-    See settings.py::Config for more details about the cache.
+
+
+def create_migration_entitlements(app):
+    """Populate the migration entitlement table, used to perform migration.
+
+    Entitlements are computed from the request history only for migration
+    groups which have none yet, so this normally happens just once, on the
+    first startup after configuring `ASSET_MIGRATION_MAP`. Claims are then
+    tracked in the database, so they survive restarts and are shared between
+    processes.
     """
     mig_map = app.config["ASSET_MIGRATION_MAP"]
     if mig_map is None:
@@ -122,44 +150,100 @@ def create_user_migration_cache(app):
 
     with app.app_context():
         rev_mig_map = {v: k for k, v in mig_map.items()}
-
-        reqs_waiting_for_migration = _get_all_requests_waiting_for_migration(rev_mig_map)
-
-        # build asset migration cache
-        mig_cache = {}
-        for req in reqs_waiting_for_migration:
-            new_asset_id = rev_mig_map.get(req.asset_id)
-            if new_asset_id is not None:
-                group, asset = _get_group_and_asset_from_id(app, new_asset_id)
-                if group not in mig_cache:
-                    mig_cache[group] = {}
-                # only consider (old) requests with xPub wallet ID
-                if len(req.wallet_id) > 64:
-                    wallet_id = get_sha256_hex(req.wallet_id)
-                    if wallet_id not in mig_cache[group]:
-                        mig_cache[group][wallet_id] = asset
-        app.config["ASSET_MIGRATION_CACHE"] = mig_cache
-
-        # update pending requests for old assets
-        for req in Request.query.filter(
-            and_(Request.status != 40, Request.asset_id.in_(rev_mig_map.keys()))
-        ):
-            # if there is a pending request for an old asset,
-            # update it with the new asset_id
-            req.asset_id = rev_mig_map[req.asset_id]
-            db.session.add(req)
-        db.session.commit()
+        asset_groups = app.config["ASSET_GROUPS"]
+
+        # only consider groups with no entitlements yet
+        groups_to_populate = {
+            group_name
+            for group_name, group in asset_groups.items()
+            if group.migration
+            and not db.session.query(  # pylint: disable=no-member
+                MigrationEntitlement.query.filter_by(asset_group=group_name).exists()
+            ).scalar()
+        }
+        if groups_to_populate:
+            added = set()
+            entitlements = []
+            for old_wallet_id, old_asset_id in _get_all_requests_waiting_for_migration(rev_mig_map):
+                group, asset = _get_group_and_asset_from_id(app, rev_mig_map[old_asset_id])
+                wallet_id = get_sha256_hex(old_wallet_id)
+                if group not in groups_to_populate or (group, wallet_id) in added:
+                    continue
+                added.add((group, wallet_id))
+                entitlements.append(
+                    {"asset_group": group, "wallet_id": wallet_id, "asset_id": asset["asset_id"]}
+                )
+            try:
+                if entitlements:
+                    db.session.execute(  # pylint: disable=no-member
+                        insert(MigrationEntitlement), entitlements
+                    )
+                db.session.commit()  # pylint: disable=no-member
+                app.logger.info(f"{len(entitlements)} migration entitlements added.")
+            except IntegrityError:
+                # another process has populated the entitlements concurrently
+                db.session.rollback()  # pylint: disable=no-member
+
+        # if there are pending requests for an old asset,
+        # update them with the new asset_id
+        for old_asset_id, new_asset_id in rev_mig_map.items():
+            Request.query.filter(Request.status != 40, Request.asset_id == old_asset_id).update(
+                {"asset_id": new_asset_id}, synchronize_session=False
+            )
+        db.session.commit()  # pylint: disable=no-member
 
         # log the current migration state
-        if len(mig_cache):
-            remaining = len(set().union(*mig_cache.values()))
-            app.logger.info(f"{remaining} wallets are still not fully migrated.")
+        unclaimed = MigrationEntitlement.query.filter(MigrationEntitlement.claimed_at.is_(None))
+        if db.session.query(unclaimed.exists()).scalar():  # pylint: disable=no-member
+            app.logger.info("Some wallets are still not fully migrated.")
         else:
             app.logger.warning(
                 "All wallets are migrated! You can drop `ASSET_MIGRATION_MAP` from config now."
             )
 
 
+def start_scheduler(app):
+    """Add the task jobs to the scheduler and start it."""
+    scheduler.init_app(app)
+    scheduler.add_job(
+        func=tasks.batch_donation,
+        trigger="interval",
+        seconds=app.config["SCHEDULER_INTERVAL"],
+        id="batch_donation",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        func=tasks.refresh_transfers,
+        trigger="interval",
+        seconds=app.config["REFRESH_INTERVAL"],
+        id="refresh_transfers",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        func=tasks.random_distribution,
+        trigger="interval",
+        seconds=app.config["SCHEDULER_INTERVAL"],
+        id="random_distribution",
+        replace_existing=True,
+    )
+    scheduler.add_job(
+        func=tasks.sweep_stale_requests,
+        trigger="interval",
+        seconds=app.config["SWEEP_INTERVAL"],
+        id="sweep_stale_requests",
+        replace_existing=True,
+    )
+    if app.config["ARCHIVE_AFTER_DAYS"] is not None:
+        scheduler.add_job(
+            func=tasks.archive_requests,
+            trigger="interval",
+            seconds=app.config["ARCHIVE_INTERVAL"],
+            id="archive_requests",
+            replace_existing=True,
+        )
+    scheduler.start()
+
+
 def create_app(custom_get_app=None, do_init_wallet=True):
     """Create and configure the app.
 
@@ -187,20 +271,22 @@ def create_app(custom_get_app=None, do_init_wallet=True):
             app.config["ELECTRUM_URL"], wallet_data
         )
 
-    # ensure all the configured assets are available
+    # fill the asset metadata cache and ensure all configured assets are available
     wallet = app.config["WALLET"]
-    assets = wallet.list_assets([])
-    asset_ids = [asset.asset_id for asset in assets.nia + assets.cfa]
+    app.config["ASSET_METADATA_CACHE"] = {}
+    app.config["WALLET_SNAPSHOT"] = None
+    asset_cache = update_asset_cache(app.config, wallet.list_assets([]))
     for _, data in app.config["ASSETS"].items():
         for asset in data["assets"]:
             asset_id = asset["asset_id"]
-            if asset_id not in asset_ids:
-                print_assets_and_quit(assets, asset_id)
+            if asset_id not in asset_cache:
+                print_assets_and_quit(asset_cache, asset_id)
 
     # initialize DB
     db.init_app(app)
     migrate.init_app(app, db)
     with app.app_context():
+        configure_sqlite(db.engine, app.config)
         upgrade()
 
     # configure logging (needs to be after migration as alembic resets it)
@@ -223,7 +309,7 @@ def create_app(custom_get_app=None, do_init_wallet=True):
 
     # pylint: enable=no-member
 
-    create_user_migration_cache(app)
+    create_migration_entitlements(app)
 
     # register blueprints
     app.register_blueprint(control.bp)
@@ -234,24 +320,9 @@ def create_app(custom_get_app=None, do_init_wallet=True):
     if app.config["BEHIND_PROXY"]:
         app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)
 
-    # initialize the scheduler, only if not already running
+    # initialize the scheduler, only if enabled and not already running
     # this is necessary when re-starting the app from tests
-    if scheduler.state == STATE_STOPPED:
-        scheduler.init_app(app)
-        scheduler.add_job(
-            func=tasks.batch_donation,
-            trigger="interval",
-            seconds=app.config["SCHEDULER_INTERVAL"],
-            id="batch_donation",
-            replace_existing=True,
-        )
-        scheduler.add_job(
-            func=tasks.random_distribution,
-            trigger="interval",
-            seconds=app.config["SCHEDULER_INTERVAL"],
-            id="random_distribution",
-            replace_existing=True,
-        )
-        scheduler.start()
+    if app.config["SCHEDULER_ENABLED"] and scheduler.state == STATE_STOPPED:
+        start_scheduler(app)
 
     return app
@@ -0,0 +1,239 @@
+"""Batching policies, deciding when pending requests are sent and in which amounts.
+
+Each asset group can select its policy via the optional 'batching' key of its
+ASSETS configuration, e.g. {"policy": "adaptive", "max_wait_minutes": 5}. The
+other keys are policy parameters, overriding the defaults. Groups with no
+'batching' key use the static policy.
+
+On each scheduler run, the policy of each asset with pending requests returns
+its BatchLimits, see plan_batches and is_batch_due in the scheduler module.
+"""
+
+import math
+from abc import ABC, abstractmethod
+from collections import namedtuple
+
+from sqlalchemy import func
+
+from .database import Request, db
+from .utils import PENDING_TRANSFER_STATUSES
+
+BatchLimits = namedtuple("BatchLimits", ["min_requests", "max_wait", "max_recipients"])
+BatchLimits.__doc__ = """Limits for the pending requests of an asset.
+
+min_requests:   number of pending requests to send even before max_wait
+max_wait:       max wait in seconds, since the oldest pending request, before sending
+max_recipients: max number of the asset's requests sent in a single batch
+"""
+
+
+class BatchContext:
+    """Faucet state shared by batching policies during a scheduler run.
+
+    Data which needs to be queried is only loaded when first requested.
+    """
+
+    def __init__(self, cfg, now, spare_utxos):
+        self.cfg = cfg
+        self.now = now
+        self.spare_utxos = spare_utxos
+        self._arrivals = {}
+        self._pending_sends = None
+
+    def get_arrivals(self, asset_id, window):
+        """Return the number of requests for the given asset in the last window seconds."""
+        if window not in self._arrivals:
+            rows = (
+                db.session.query(  # pylint: disable=no-member
+                    Request.asset_id, func.count(Request.idx)
+                )
+                .filter(Request.timestamp > self.now - window)
+                .group_by(Request.asset_id)
+            )
+            self._arrivals[window] = dict(rows.all())
+        return self._arrivals[window].get(asset_id, 0)
+
+    def get_pending_sends(self, asset_id):
+        """Return the number of the asset's sends waiting for completion.
+
+        Sends are counted from the wallet state snapshot, as the number of
+        distinct transactions of pending outgoing transfers.
+        """
+        if self._pending_sends is None:
+            self._pending_sends = {}
+            snapshot = self.cfg["WALLET_SNAPSHOT"]
+            for snap_asset_id, by_status in (snapshot or {}).get("transfers", {}).items():
+                txids = {
+                    transfer["txid"]
+                    for status in PENDING_TRANSFER_STATUSES
+                    for transfer in by_status.get(status, [])
+                    if transfer["kind"] == "SEND"
+                }
+                self._pending_sends[snap_asset_id] = len(txids)
+        return self._pending_sends.get(asset_id, 0)
+
+
+class BatchingPolicy(ABC):
+    """Batching policy interface.
+
+    A policy is built once on startup, from the group's 'batching'
+    configuration, and can be shared by all of the group's assets.
+    """
+
+    # supported configuration parameters (positive integers, numbers for minutes)
+    PARAMS = ()
+
+    def __init__(self, **params):
+        self.params = params
+
+    def get_param(self, cfg, name):
+        """Return the given parameter, falling back to the configuration default."""
+        if name in self.params:
+            return self.params[name]
+        return cfg[name.upper()]
+
+    @abstractmethod
+    def get_limits(self, asset_id, pending, context):
+        """Return the BatchLimits for the given asset.
+
+        pending holds the asset's pending request stats (see get_pending_stats)
+        and context is the BatchContext of the current scheduler run.
+        """
+
+
+class StaticPolicy(BatchingPolicy):
+    """Static thresholds.
+
+    Batches are sent when they reach min_requests or when their oldest
+    request has waited max_wait_minutes, with up to max_recipients requests
+    per asset. Parameters default to the MIN_REQUESTS, MAX_WAIT_MINUTES and
+    MAX_BATCH_RECIPIENTS configuration variables.
+    """
+
+    PARAMS = ("min_requests", "max_wait_minutes", "max_batch_recipients")
+
+    def get_limits(self, asset_id, _pending, context):
+        cfg = context.cfg
+        return BatchLimits(
+            min_requests=self.get_param(cfg, "min_requests"),
+            max_wait=self.get_param(cfg, "max_wait_minutes") * 60,
+            max_recipients=self.get_param(cfg, "max_batch_recipients"),
+        )
+
+
+class AdaptivePolicy(BatchingPolicy):
+    """Thresholds adapting to traffic and wallet state.
+
+    The trigger (min_requests) is the number of requests expected to arrive
+    in target_wait_minutes, at the arrival rate measured over the last
+    window_minutes. It is multiplied by one plus the number of the asset's
+    sends still waiting for completion, as new small sends would pile up on
+    them, and it is raised to the max batch size when spare UTXOs are below
+    SPARE_UTXO_THRESH, so scarce UTXOs are used by full batches only. The
+    trigger is kept between min_requests and max_batch_recipients.
+
+    The max batch size is twice the trigger, so sends stay close to the size
+    they have been waiting for, but grows with the asset's pending requests,
+    so a backlog (e.g. left by a burst which is no longer in the arrival
+    window) is drained within about target_wait_minutes, one send per
+    SCHEDULER_INTERVAL. It is capped at max_batch_recipients.
+
+    Requests are never kept waiting for longer than max_wait_minutes.
+    Parameters default to the configuration variables with the same
+    (uppercase) name, target_wait_minutes to half of max_wait_minutes and
+    window_minutes to max_wait_minutes.
+    """
+
+    PARAMS = (
+        "min_requests",
+        "max_wait_minutes",
+        "max_batch_recipients",
+        "target_wait_minutes",
+        "window_minutes",
+    )
+
+    def get_param(self, cfg, name):
+        if name not in self.params and name == "target_wait_minutes":
+            return self.get_param(cfg, "max_wait_minutes") / 2
+        if name not in self.params and name == "window_minutes":
+            return self.get_param(cfg, "max_wait_minutes")
+        return super().get_param(cfg, name)
+
+    def get_limits(self, asset_id, pending, context):
+        cfg = context.cfg
+        min_requests = self.get_param(cfg, "min_requests")
+        max_recipients = self.get_param(cfg, "max_batch_recipients")
+        target_wait = self.get_param(cfg, "target_wait_minutes") * 60
+        window = self.get_param(cfg, "window_minutes") * 60
+        rate = context.get_arrivals(asset_id, window) / window
+        trigger = math.ceil(rate * target_wait)
+        trigger *= 1 + context.get_pending_sends(asset_id)
+        if context.spare_utxos < cfg["SPARE_UTXO_THRESH"]:
+            trigger = max_recipients
+        trigger = max(min_requests, min(trigger, max_recipients))
+        # sends needed to drain the backlog within the target wait
+        drain_sends = max(target_wait / cfg["SCHEDULER_INTERVAL"], 1)
+        size = max(2 * trigger, math.ceil(pending["count"] / drain_sends))
+        return BatchLimits(
+            min_requests=trigger,
+            max_wait=self.get_param(cfg, "max_wait_minutes") * 60,
+            max_recipients=min(size, max_recipients),
+        )
+
+
+BATCHING_POLICIES = {
+    "static": StaticPolicy,
+    "adaptive": AdaptivePolicy,
+}
+
+
+def check_batching(app, group_name, group_val, errors):
+    """Check the batching configuration (if any) for the given group.
+
+    min_requests can't be larger than max_batch_recipients, as batches would
+    then only be sent after waiting for max_wait_minutes.
+    """
+    err_end = f"for group {group_name}"
+    batching_conf = group_val.get("batching")
+    if batching_conf is None:
+        return
+    if not isinstance(batching_conf, dict):
+        errors.append(f"batching configuration {err_end} is not a dictionary")
+        return
+    policy = BATCHING_POLICIES.get(batching_conf.get("policy"))
+    if policy is None:
+        errors.append(
+            f'unsupported batching policy "{batching_conf.get("policy")}" {err_end}, '
+            f'supported ones: {", ".join(BATCHING_POLICIES)}'
+        )
+        return
+    param_errors = _check_batching_params(policy, batching_conf, err_end)
+    if param_errors:
+        errors.extend(param_errors)
+        return
+    group_policy = build_policy(group_val)
+    min_requests = group_policy.get_param(app.config, "min_requests")
+    if min_requests > group_policy.get_param(app.config, "max_batch_recipients"):
+        errors.append(f"batching param min_requests {err_end} is larger than max_batch_recipients")
+
+
+def _check_batching_params(policy, batching_conf, err_end):
+    """Return the errors in the given batching parameters for the given policy."""
+    errors = []
+    for param, value in batching_conf.items():
+        if param == "policy":
+            continue
+        if param not in policy.PARAMS:
+            errors.append(f"unsupported batching param {param} {err_end}")
+        elif param.endswith("_minutes"):
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                errors.append(f"batching param {param} {err_end} is not a positive number")
+        elif isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+            errors.append(f"batching param {param} {err_end} is not a positive integer")
+    return errors
+
+
+def build_policy(group_val):
+    """Return the batching policy for the given group configuration."""
+    params = dict(group_val.get("batching") or {"policy": "static"})
+    return BATCHING_POLICIES[params.pop("policy")](**params)
@@ -1,29 +1,47 @@
 """Faucet blueprint to top-up funds."""
 
+import itertools
+import json
+
 import rgb_lib
-from flask import Blueprint, current_app, jsonify, request
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context
 from rgb_lib import TransferStatus
+from sqlalchemy import select
 
-from faucet_rgb import utils
+from faucet_rgb import export, utils
 
-from .database import Request
+from .database import Request, RequestArchive, db
 
 bp = Blueprint("control", __name__, url_prefix="/control")
 
+# request fields returned by /control/requests
+REQUEST_FIELDS = (
+    "idx",
+    "timestamp",
+    "status",
+    "wallet_id",
+    "recipient_id",
+    "invoice",
+    "asset_group",
+    "asset_id",
+    "amount",
+)
+# default and max number of requests returned in a page by /control/requests
+REQUESTS_PAGE_SIZE = 100
+REQUESTS_PAGE_MAX = 1000
+# number of requests fetched at a time when streaming
+REQUESTS_STREAM_CHUNK_SIZE = 1000
+
 
 @bp.route("/assets", methods=["GET"])
 def assets():
-    """Return the list of RGB assets from rgb-lib."""
+    """Return the list of RGB assets, from the wallet state snapshot."""
     auth = request.headers.get("X-Api-Key")
     if auth != current_app.config["API_KEY_OPERATOR"]:
         return jsonify({"error": "unauthorized"}), 401
 
-    online = current_app.config["ONLINE"]
-    wallet = current_app.config["WALLET"]
-    wallet.refresh(online, None, [])
-    asset_list = wallet.list_assets([])
-    asset_dict = utils.get_asset_dict(asset_list.nia + asset_list.cfa)
-    return jsonify({"assets": asset_dict})
+    snapshot = utils.get_wallet_snapshot(current_app.config, _is_fresh_requested())
+    return jsonify({"assets": snapshot["assets"], "timestamp": snapshot["timestamp"]})
 
 
 @bp.route("/delete", methods=["GET"])
@@ -35,6 +53,7 @@ def delete_transfers():
 
     wallet = current_app.config["WALLET"]
     res = wallet.delete_transfers(None, None, False)
+    utils.invalidate_wallet_snapshot(current_app.config)
     return jsonify({"result": res}), 200
 
 
@@ -48,6 +67,7 @@ def fail_transfers():
     online = current_app.config["ONLINE"]
     wallet = current_app.config["WALLET"]
     res = wallet.fail_transfers(online, None, None, False)
+    utils.invalidate_wallet_snapshot(current_app.config)
     return jsonify({"result": res}), 200
 
 
@@ -59,7 +79,14 @@ def list_transfers():
     the list_transfers rgb-lib API is mandatory.
 
     Pending transfers are listed by default. If a valid status is provided via
-    query parameter, then transfers in that status are returned instead.
+    query parameter, then transfers in that status are returned instead. If an
+    asset_id is provided, only transfers of that asset are returned.
+
+    Transfers are served from the wallet state snapshot, along with its
+    transfer generation, which changes only when transfers are listed again.
+    If 'limit' is provided, at most 'limit' transfers are returned, skipping
+    the first 'offset' ones, and the response 'has_more' field tells if more
+    transfers match.
     """
     auth = request.headers.get("X-Api-Key")
     if auth != current_app.config["API_KEY_OPERATOR"]:
@@ -76,37 +103,29 @@ def list_transfers():
             return jsonify({"error": f"unknown status requested: {status}"}), 403
         status_filter = [getattr(TransferStatus, status.upper())]
 
-    # refresh and list transfers in matching status(es)
-    online = current_app.config["ONLINE"]
-    wallet = current_app.config["WALLET"]
-    wallet.refresh(online, None, [])
-    asset_list = wallet.list_assets([])
-    asset_ids = [a.asset_id for a in asset_list.nia + asset_list.cfa]
-    transfers = []
-    for asset_id in asset_ids:
-        asset_transfers = wallet.list_transfers(asset_id)
-        for transfer in asset_transfers:
-            if transfer.status not in status_filter:
-                continue
-            ttes = [
-                {
-                    "endpoint": tte.endpoint,
-                    "transport_type": tte.transport_type.name,
-                    "used": tte.used,
-                }
-                for tte in transfer.transport_endpoints
-            ]
-            transfers.append(
-                {
-                    "status": transfer.status.name,
-                    "amount": transfer.amount,
-                    "kind": transfer.kind.name,
-                    "txid": transfer.txid,
-                    "recipient_id": transfer.recipient_id,
-                    "transfer_transport_endpoints": ttes,
-                }
-            )
-    return jsonify({"transfers": transfers})
+    try:
+        offset, limit = _get_offset_limit()
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+
+    snapshot = utils.get_wallet_snapshot(current_app.config, _is_fresh_requested())
+    asset_id = request.args.get("asset_id") or None
+    if asset_id is not None and asset_id not in snapshot["transfers"]:
+        return jsonify({"error": f"unknown asset ID: {asset_id}"}), 404
+    transfers = utils.filter_transfers(
+        snapshot["transfers"], [s.name for s in status_filter], asset_id
+    )
+    # get an extra transfer to know if there are more
+    stop = None if limit is None else offset + limit + 1
+    page = list(itertools.islice(transfers, offset, stop))
+    return jsonify(
+        {
+            "transfers": page[:limit],
+            "has_more": limit is not None and len(page) > limit,
+            "generation": snapshot["generation"],
+            "timestamp": snapshot["timestamp"],
+        }
+    )
 
 
 @bp.route("/refresh/<asset_id>", methods=["GET"])
@@ -116,10 +135,9 @@ def refresh(asset_id):
     if auth != current_app.config["API_KEY_OPERATOR"]:
         return jsonify({"error": "unauthorized"}), 401
 
-    online = current_app.config["ONLINE"]
-    wallet = current_app.config["WALLET"]
     try:
-        res = wallet.refresh(online, asset_id, [])
+        res = utils.refresh_wallet(current_app.config, asset_id)
+        utils.invalidate_wallet_snapshot(current_app.config)
         return jsonify({"result": res}), 200
     except rgb_lib.RgbLibError.AssetNotFound:
         return jsonify({"error": f"unknown asset ID: {asset_id}"}), 404
@@ -127,71 +145,218 @@ def refresh(asset_id):
         return jsonify({"error": f"unknown error: {err}"}), 500
 
 
+@bp.route("/refresh_stats", methods=["GET"])
+def refresh_stats():
+    """Return wallet refresh stats.
+
+    Stats (count, changes, errors, total and last duration, last time) are
+    returned for whole-wallet refreshes and per asset, along with the assets
+    with pending transfers (refreshed on every scheduler run) and the time of
+    the next whole-wallet refresh.
+    """
+    auth = request.headers.get("X-Api-Key")
+    if auth != current_app.config["API_KEY_OPERATOR"]:
+        return jsonify({"error": "unauthorized"}), 401
+
+    stats = current_app.config["REFRESH_STATS"] or {"wallet": None, "assets": {}}
+    backoff = current_app.config["REFRESH_BACKOFF"]
+    return jsonify(
+        {
+            "wallet": stats["wallet"],
+            "assets": stats["assets"],
+            "pending_assets": utils.get_pending_asset_ids(current_app.config["WALLET_SNAPSHOT"]),
+            "next_wallet_refresh": None if backoff is None else backoff["next"],
+        }
+    )
+
+
+@bp.route("/export", methods=["GET"])
+def export_requests():
+    """Export requests as CSV (default) or Parquet.
+
+    Request can include the following query parameters:
+    - 'format': 'csv' or 'parquet' (requires the optional pyarrow package)
+    - 'status', 'asset_group', 'asset_id': filters
+    - 'since' and 'until': timestamp range (since included, until excluded)
+    - 'archived': if set to a true value, archived requests are exported
+
+    Requests are streamed in idx order, reading them in chunks through a
+    read-only database connection, so the scheduler is never blocked.
+    """
+    auth = request.headers.get("X-Api-Key")
+    if auth != current_app.config["API_KEY_OPERATOR"]:
+        return jsonify({"error": "unauthorized"}), 401
+
+    fmt = request.args.get("format", "csv")
+    if fmt not in export.EXPORT_FORMATS:
+        return jsonify({"error": f"unsupported format: {fmt}"}), 400
+    if fmt == "parquet" and export.pyarrow is None:
+        return jsonify({"error": "parquet export requires the pyarrow package"}), 400
+    try:
+        filters = _get_int_args(("since", "status", "until"))
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    filters["asset_group"] = request.args.get("asset_group") or None
+    filters["asset_id"] = request.args.get("asset_id") or None
+
+    query = export.get_export_query(filters, _is_archived_requested())
+    engine = export.create_readonly_engine(current_app.config["SQLALCHEMY_DATABASE_URI"])
+
+    def _generate():
+        try:
+            yield from export.iter_export(engine, query, fmt)
+        finally:
+            engine.dispose()
+
+    mimetype = "text/csv" if fmt == "csv" else "application/vnd.apache.parquet"
+    return Response(
+        _generate(),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename=requests.{fmt}"},
+    )
+
+
 @bp.route("/requests", methods=["GET"])
 def list_requests():
     """Return requests.
 
-    Max 100 requests are returned.
+    Requests are returned in pages of 'limit' (default 100, max 1000) items,
+    newest first. Further pages are requested by idx (keyset pagination):
+    - 'before': only return requests with a lower idx (newest first)
+    - 'after': only return requests with a higher idx (oldest first)
+    The response 'has_more' field tells if more requests match.
+
     Request can include filters as query parameters:
     - 'status'
     - 'asset_group'
     - 'asset_id'
     - 'recipient_id'
     - 'wallet_id'
+    - 'since' and 'until': timestamp range (since included, until excluded)
 
-    If no filter is provided, all requests in status 20 are returned
+    If no filter is provided, all requests in status 20 are returned.
+    If 'archived' is set to a true value, archived requests are returned.
+    If 'format' is set to 'ndjson', all matching requests (max 'limit', if
+    provided) are streamed as newline-delimited JSON, with the same order.
     """
     auth = request.headers.get("X-Api-Key")
     if auth != current_app.config["API_KEY_OPERATOR"]:
         return jsonify({"error": "unauthorized"}), 401
 
-    asset_group = request.args.get("asset_group")
-    asset_id = request.args.get("asset_id")
-    recipient_id = request.args.get("recipient_id")
-    status = request.args.get("status")
-    wallet_id = request.args.get("wallet_id")
-    if all(a is None for a in [asset_group, asset_id, recipient_id, status, wallet_id]):
-        status = 20
-
-    reqs = Request.query
-    if asset_group:
-        reqs = reqs.filter_by(asset_group=asset_group)
-    if asset_id:
-        reqs = reqs.filter_by(asset_id=asset_id)
-    if recipient_id:
-        reqs = reqs.filter_by(recipient_id=recipient_id)
-    if status:
-        reqs = reqs.filter_by(status=status)
-    if wallet_id:
-        reqs = reqs.filter_by(wallet_id=wallet_id)
-
-    requests = []
-    for req in reqs.order_by(Request.idx.desc()).slice(0, 100).all():
-        requests.append(
-            {
-                "idx": req.idx,
-                "timestamp": req.timestamp,
-                "status": req.status,
-                "wallet_id": req.wallet_id,
-                "recipient_id": req.recipient_id,
-                "invoice": req.invoice,
-                "asset_group": req.asset_group,
-                "asset_id": req.asset_id,
-                "amount": req.amount,
-            }
+    try:
+        int_args = _get_int_args(("after", "before", "limit", "since", "status", "until"))
+    except ValueError as err:
+        return jsonify({"error": str(err)}), 400
+    limit = int_args.get("limit")
+    if limit is not None and limit < 1:
+        return jsonify({"error": f"invalid limit: {limit}"}), 400
+
+    model = RequestArchive if _is_archived_requested() else Request
+    query = _get_requests_query(model, int_args)
+
+    if request.args.get("format") == "ndjson":
+        if limit is not None:
+            query = query.limit(limit)
+        return Response(
+            stream_with_context(_stream_requests(query)), mimetype="application/x-ndjson"
         )
 
-    return jsonify({"requests": requests})
+    limit = min(limit or REQUESTS_PAGE_SIZE, REQUESTS_PAGE_MAX)
+    # get an extra request to know if there are more
+    rows = db.session.execute(query.limit(limit + 1)).all()  # pylint: disable=no-member
+    return jsonify(
+        {
+            "requests": [row._asdict() for row in rows[:limit]],
+            "has_more": len(rows) > limit,
+        }
+    )
+
+
+def _get_int_args(names):
+    """Return the given query parameters, if present, converted to int.
+
+    Raise ValueError if any of them is not a valid int.
+    """
+    int_args = {}
+    for arg in names:
+        value = request.args.get(arg)
+        if value is None:
+            continue
+        try:
+            int_args[arg] = int(value)
+        except ValueError as err:
+            raise ValueError(f"invalid {arg}: {value}") from err
+    return int_args
+
+
+def _get_offset_limit():
+    """Return the 'offset' (default 0) and 'limit' (default None) query parameters.
+
+    Raise ValueError if any of them is invalid.
+    """
+    int_args = _get_int_args(("limit", "offset"))
+    limit = int_args.get("limit")
+    offset = int_args.get("offset", 0)
+    if limit is not None and limit < 1:
+        raise ValueError(f"invalid limit: {limit}")
+    if offset < 0:
+        raise ValueError(f"invalid offset: {offset}")
+    return offset, limit
+
+
+def _is_archived_requested():
+    """Return if archived requests have been requested via query parameter."""
+    return request.args.get("archived", "").lower() in ("1", "true")
+
+
+def _is_fresh_requested():
+    """Return if fresh wallet data has been requested via query parameter."""
+    return request.args.get("fresh", "").lower() in ("1", "true")
+
+
+def _get_requests_query(model, int_args):
+    """Return the query selecting the requested page of requests."""
+    filters = {
+        arg: request.args.get(arg)
+        for arg in ("asset_group", "asset_id", "recipient_id", "wallet_id")
+        if request.args.get(arg)
+    }
+    if "status" in int_args:
+        filters["status"] = int_args["status"]
+    elif not filters and "since" not in int_args and "until" not in int_args:
+        filters["status"] = 20
+
+    query = select(*(getattr(model, field) for field in REQUEST_FIELDS)).filter_by(**filters)
+    if "since" in int_args:
+        query = query.where(model.timestamp >= int_args["since"])
+    if "until" in int_args:
+        query = query.where(model.timestamp < int_args["until"])
+    if "before" in int_args:
+        query = query.where(model.idx < int_args["before"])
+    if "after" in int_args:
+        return query.where(model.idx > int_args["after"]).order_by(model.idx)
+    return query.order_by(model.idx.desc())
+
+
+def _stream_requests(query):
+    """Yield the requests selected by the given query as NDJSON lines.
+
+    Rows are fetched in chunks from a server-side cursor (where supported),
+    so memory usage doesn't depend on the number of requests.
+    """
+    rows = db.session.execute(  # pylint: disable=no-member
+        query.execution_options(yield_per=REQUESTS_STREAM_CHUNK_SIZE)
+    )
+    for row in rows:
+        yield json.dumps(row._asdict()) + "\n"
 
 
 @bp.route("/unspents", methods=["GET"])
 def unspents():
-    """Return the list of wallet unspents."""
+    """Return the list of wallet unspents, from the wallet state snapshot."""
     auth = request.headers.get("X-Api-Key")
     if auth != current_app.config["API_KEY_OPERATOR"]:
         return jsonify({"error": "unauthorized"}), 401
 
-    online = current_app.config["ONLINE"]
-    wallet = current_app.config["WALLET"]
-    unspent_list = utils.wallet.get_unspent_list(wallet, online)
-    return jsonify({"unspents": unspent_list})
+    snapshot = utils.get_wallet_snapshot(current_app.config, _is_fresh_requested())
+    return jsonify({"unspents": snapshot["unspents"], "timestamp": snapshot["timestamp"]})
@@ -2,6 +2,7 @@
 
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, insert, select
 
 from .utils import get_current_timestamp
 
@@ -15,12 +16,62 @@ STATUS_MAP = {
     30: "processing",
     40: "served",
     45: "unmet",
+    50: "failed",
 }
 
 
+# max number of idxs bound to a single bulk UPDATE statement
+BULK_CHUNK_SIZE = 10000
+
+# SQLite pragmas set on each new connection, mapped to their config variable
+# busy_timeout comes first so the journal mode switch waits for locks
+SQLITE_PRAGMAS = {
+    "busy_timeout": "SQLITE_BUSY_TIMEOUT",
+    "journal_mode": "SQLITE_JOURNAL_MODE",
+    "synchronous": "SQLITE_SYNCHRONOUS",
+    "mmap_size": "SQLITE_MMAP_SIZE",
+    "cache_size": "SQLITE_CACHE_SIZE",
+}
+
+
+def configure_sqlite(engine, config):
+    """Set the configured pragmas on each new connection of a SQLite engine.
+
+    Pragmas configured as None are left to the SQLite default. Engines for
+    other database backends are left untouched.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    pragmas = [
+        (pragma, config[cfg_var])
+        for pragma, cfg_var in SQLITE_PRAGMAS.items()
+        if config[cfg_var] is not None
+    ]
+    if not pragmas:
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas:
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.close()
+
+
 class Request(db.Model):  # pylint: disable=too-few-public-methods,too-many-instance-attributes
     """Request model."""
 
+    __table_args__ = (
+        # eligibility checks (already requested from group)
+        db.Index("ix_request_wallet_id_asset_group", "wallet_id", "asset_group"),
+        # batch sending (pending requests, optionally for a single asset)
+        db.Index("ix_request_status_asset_id_idx", "status", "asset_id", "idx"),
+        # cleanup of stale requests and oldest request lookup
+        db.Index("ix_request_status_timestamp", "status", "timestamp"),
+        # recent arrivals per asset (adaptive batching)
+        db.Index("ix_request_timestamp_asset_id", "timestamp", "asset_id"),
+    )
+
     idx = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.Integer, nullable=False)
     status = db.Column(db.Integer, nullable=False)
@@ -30,18 +81,51 @@ class Request(db.Model):  # pylint: disable=too-few-public-methods,too-many-inst
     asset_group = db.Column(db.String(256), nullable=False)
     asset_id = db.Column(db.String(256), nullable=True)
     amount = db.Column(db.Integer, nullable=True)
+    # recipient data parsed from the invoice at ingestion (None for old requests)
+    witness = db.Column(db.Boolean, nullable=True)
+    transport_endpoints = db.Column(db.JSON, nullable=True)
 
     # pylint: disable=too-many-arguments
-    def __init__(self, wallet_id, recipient_id, invoice, asset_group, asset_id, amount):
+    def __init__(
+        self,
+        wallet_id,
+        recipient_id,
+        invoice,
+        asset_group,
+        asset_id,
+        amount,
+        status=10,
+        witness=None,
+        transport_endpoints=None,
+    ):
         # pylint: disable=too-many-arguments
         self.timestamp = get_current_timestamp()
-        self.status = 10
+        self.status = status
         self.wallet_id = wallet_id
         self.recipient_id = recipient_id
         self.invoice = invoice
         self.asset_group = asset_group
         self.asset_id = asset_id
         self.amount = amount
+        self.witness = witness
+        self.transport_endpoints = transport_endpoints
+
+    @classmethod
+    def update_status(cls, idxs, from_status, to_status):
+        """Move the requests with the given idxs from one status to another.
+
+        Requests not in from_status are left untouched. Updates are done with a
+        single UPDATE statement for up to BULK_CHUNK_SIZE idxs and are not
+        committed. Return the number of updated requests.
+        """
+        updated = 0
+        for start in range(0, len(idxs), BULK_CHUNK_SIZE):
+            end = start + BULK_CHUNK_SIZE
+            chunk = idxs[start:end]
+            updated += cls.query.filter(cls.idx.in_(chunk), cls.status == from_status).update(
+                {"status": to_status}, synchronize_session=False
+            )
+        return updated
 
     def __str__(self):
         return (
@@ -49,3 +133,116 @@ class Request(db.Model):  # pylint: disable=too-few-public-methods,too-many-inst
             f"{self.wallet_id} {self.recipient_id} {self.invoice} "
             f"{self.asset_group} {self.asset_id} {self.amount}"
         )
+
+
+class RequestArchive(db.Model):  # pylint: disable=too-few-public-methods
+    """Archived request model.
+
+    Served and unmet requests are moved here from the request table (keeping
+    their idx) by the archiver task, so the request table stays small.
+    """
+
+    __tablename__ = "request_archive"
+    __table_args__ = (
+        # eligibility checks (already requested from group)
+        db.Index("ix_request_archive_wallet_id_asset_group", "wallet_id", "asset_group"),
+    )
+
+    idx = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    timestamp = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.Integer, nullable=False)
+    wallet_id = db.Column(db.String(256), nullable=False)
+    recipient_id = db.Column(db.String(256), nullable=False)
+    invoice = db.Column(db.String(256), nullable=False)
+    asset_group = db.Column(db.String(256), nullable=False)
+    asset_id = db.Column(db.String(256), nullable=True)
+    amount = db.Column(db.Integer, nullable=True)
+    witness = db.Column(db.Boolean, nullable=True)
+    transport_endpoints = db.Column(db.JSON, nullable=True)
+
+    @classmethod
+    def archive(cls, idxs):
+        """Move the requests with the given idxs to the archive table.
+
+        Rows are copied and deleted with one INSERT ... SELECT and one DELETE
+        statement, which are not committed.
+        """
+        columns = [column.name for column in cls.__table__.columns]
+        db.session.execute(  # pylint: disable=no-member
+            insert(cls).from_select(
+                columns,
+                select(*(Request.__table__.c[column] for column in columns)).where(
+                    Request.idx.in_(idxs)
+                ),
+            )
+        )
+        Request.query.filter(Request.idx.in_(idxs)).delete(synchronize_session=False)
+
+
+class Claim(db.Model):  # pylint: disable=too-few-public-methods
+    """Claim model.
+
+    A wallet can request from each asset group once, which is enforced by the
+    unique constraint: a claim is added along with each request, failing if
+    the wallet has already requested from the group.
+    """
+
+    __table_args__ = (
+        # claims and eligibility checks (already requested from group)
+        db.UniqueConstraint("wallet_id", "asset_group", name="uq_claim_wallet_id_asset_group"),
+    )
+
+    idx = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.Integer, nullable=False)
+    wallet_id = db.Column(db.String(256), nullable=False)
+    asset_group = db.Column(db.String(256), nullable=False)
+
+    def __init__(self, wallet_id, asset_group):
+        self.timestamp = get_current_timestamp()
+        self.wallet_id = wallet_id
+        self.asset_group = asset_group
+
+
+class MigrationEntitlement(db.Model):  # pylint: disable=too-few-public-methods
+    """Migration entitlement model.
+
+    A wallet is entitled to receive the given (new) asset from a migration
+    group once. Entitlements are claimed by setting claimed_at.
+    """
+
+    __tablename__ = "migration_entitlement"
+    __table_args__ = (
+        # claims and per-wallet lookups
+        db.UniqueConstraint(
+            "wallet_id", "asset_group", name="uq_migration_entitlement_wallet_id_asset_group"
+        ),
+        # unclaimed entitlements per group (migration complete check)
+        db.Index("ix_migration_entitlement_asset_group_claimed_at", "asset_group", "claimed_at"),
+    )
+
+    idx = db.Column(db.Integer, primary_key=True)
+    asset_group = db.Column(db.String(256), nullable=False)
+    wallet_id = db.Column(db.String(256), nullable=False)
+    asset_id = db.Column(db.String(256), nullable=False)
+    claimed_at = db.Column(db.Integer, nullable=True)
+
+    def __init__(self, asset_group, wallet_id, asset_id):
+        self.asset_group = asset_group
+        self.wallet_id = wallet_id
+        self.asset_id = asset_id
+        self.claimed_at = None
+
+    @classmethod
+    def claim(cls, asset_group, wallet_id):
+        """Claim the entitlement of a wallet for a group, if still unclaimed.
+
+        The claim is a conditional update, so only one of concurrent claims can
+        succeed, and it's not committed. Return if the claim succeeded.
+        """
+        return bool(
+            cls.query.filter(
+                cls.asset_group == asset_group,
+                cls.wallet_id == wallet_id,
+                cls.claimed_at.is_(None),
+            ).update({"claimed_at": get_current_timestamp()}, synchronize_session=False)
+        )
@@ -0,0 +1,154 @@
+"""Export of the request history, for analytics.
+
+Requests are read in chunks through a read-only connection and written as CSV
+or Parquet (requires the optional pyarrow dependency), so memory usage doesn't
+depend on the number of exported requests.
+"""
+
+import csv
+import io
+import json
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.engine import make_url
+
+from .database import Request, RequestArchive
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None  # pylint: disable=invalid-name
+
+EXPORT_COLUMNS = [column.name for column in Request.__table__.columns]
+EXPORT_FORMATS = ("csv", "parquet")
+# number of requests fetched (and written) at a time
+EXPORT_CHUNK_SIZE = 10000
+
+
+def create_readonly_engine(uri):
+    """Return an engine with read-only connections to the given database.
+
+    SQLite databases are opened in read-only mode, which never blocks the
+    scheduler's writes when in WAL mode. PostgreSQL transactions are read-only
+    and in REPEATABLE READ isolation, so each export reads a snapshot.
+    """
+    url = make_url(uri)
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        url = url.set(database=f"file:{url.database}", query={"mode": "ro", "uri": "true"})
+        return create_engine(url)
+    if backend == "postgresql":
+        return create_engine(
+            url,
+            execution_options={"isolation_level": "REPEATABLE READ", "postgresql_readonly": True},
+        )
+    return create_engine(url)
+
+
+def get_export_query(filters, archived=False):
+    """Return the query selecting the requests to be exported, ordered by idx.
+
+    Supported filters are 'status', 'asset_group', 'asset_id' (equality) and
+    'since'/'until' (timestamp range, since included, until excluded). Filters
+    with a None value are ignored.
+    """
+    table = (RequestArchive if archived else Request).__table__
+    query = select(*(table.c[column] for column in EXPORT_COLUMNS))
+    for column in ("status", "asset_group", "asset_id"):
+        if filters.get(column) is not None:
+            query = query.where(table.c[column] == filters[column])
+    if filters.get("since") is not None:
+        query = query.where(table.c.timestamp >= filters["since"])
+    if filters.get("until") is not None:
+        query = query.where(table.c.timestamp < filters["until"])
+    return query.order_by(table.c.idx)
+
+
+def iter_export(engine, query, fmt):
+    """Yield the requests selected by the query, as bytes in the given format.
+
+    Rows are fetched EXPORT_CHUNK_SIZE at a time (from a server-side cursor,
+    where supported) and each chunk is encoded and yielded before fetching
+    the next one.
+    """
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=EXPORT_CHUNK_SIZE).execute(query)
+        chunks = result.partitions()
+        if fmt == "parquet":
+            yield from _iter_parquet(chunks)
+        else:
+            yield from _iter_csv(chunks)
+
+
+def _iter_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    yield buffer.getvalue().encode()
+    for chunk in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        for row in chunk:
+            row = row._asdict()
+            if row["transport_endpoints"] is not None:
+                row["transport_endpoints"] = json.dumps(row["transport_endpoints"])
+            writer.writerow(row.values())
+        yield buffer.getvalue().encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file collecting written bytes until they're taken."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        """Return the bytes written since the last call."""
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _get_parquet_schema():
+    return pyarrow.schema(
+        [
+            ("idx", pyarrow.int64()),
+            ("timestamp", pyarrow.int64()),
+            ("status", pyarrow.int32()),
+            ("wallet_id", pyarrow.string()),
+            ("recipient_id", pyarrow.string()),
+            ("invoice", pyarrow.string()),
+            ("asset_group", pyarrow.string()),
+            ("asset_id", pyarrow.string()),
+            ("amount", pyarrow.int64()),
+            ("witness", pyarrow.bool_()),
+            ("transport_endpoints", pyarrow.list_(pyarrow.string())),
+        ]
+    )
+
+
+def _iter_parquet(chunks):
+    schema = _get_parquet_schema()
+    sink = _ChunkSink()
+    # each chunk is written as a row group
+    with pyarrow.parquet.ParquetWriter(sink, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(
+                pyarrow.Table.from_pylist([row._asdict() for row in chunk], schema=schema)
+            )
+            yield sink.take()
+    yield sink.take()
@@ -7,11 +7,13 @@ from enum import Enum
 
 import rgb_lib
 from flask import Blueprint, current_app, jsonify, request
+from sqlalchemy import case, func, select
+from sqlalchemy.exc import IntegrityError
 
 from faucet_rgb.settings import DistributionMode
 
-from .database import Request, db
-from .utils import get_current_timestamp, get_logger, get_rgb_asset, is_blinded_utxo
+from .database import Claim, MigrationEntitlement, Request, db
+from .utils import get_logger, get_rgb_asset, is_blinded_utxo
 from .utils.wallet import is_walletid_valid
 
 bp = Blueprint("receive", __name__, url_prefix="/receive")
@@ -54,18 +56,14 @@ def config(wallet_id):
     if not is_walletid_valid(wallet_id):
         return jsonify({"error": "invalied wallet ID"}), 403
 
-    # drop requests in status "new" which are older than a couple minutes
-    time_thresh = get_current_timestamp() - 120
-    Request.query.filter(Request.status == 10, Request.timestamp < time_thresh).delete()
-    db.session.commit()  # pylint: disable=no-member
-
-    assets = current_app.config["ASSETS"]
+    asset_groups = current_app.config["ASSET_GROUPS"]
+    eligibility = _get_request_eligibility(wallet_id, asset_groups)
     groups = {}
-    for group_name, group_data in assets.items():
-        (allowed, _reason) = _is_request_allowed(wallet_id, group_name)
+    for group_name, group in asset_groups.items():
+        (allowed, _reason) = eligibility[group_name]
         groups[group_name] = {
-            "label": group_data["label"],
-            "distribution": group_data["distribution"],
+            "label": group.label,
+            "distribution": group.distribution,
             "requests_left": 1 if allowed else 0,
         }
     return jsonify({"name": current_app.config["NAME"], "groups": groups})
@@ -93,10 +91,20 @@ def request_rgb_asset():  # pylint: disable=too-many-return-statements
     data = result["data"]
     invoice = result["invoice"]
 
+    # parse recipient data once, it's saved along with the request
+    invoice_data = invoice.invoice_data()
+    recipient_data = {
+        "recipient_id": invoice_data.recipient_id,
+        "invoice": invoice.invoice_string(),
+        "witness": not is_blinded_utxo(invoice_data.recipient_id),
+        "transport_endpoints": invoice_data.transport_endpoints,
+    }
+
     # refuse witness requests if not allowed for network
-    if current_app.config["NETWORK"] not in current_app.config[
-        "WITNESS_ALLOWED_NETWORKS"
-    ] and not is_blinded_utxo(invoice.invoice_data().recipient_id):
+    if (
+        current_app.config["NETWORK"] not in current_app.config["WITNESS_ALLOWED_NETWORKS"]
+        and recipient_data["witness"]
+    ):
         return (
             jsonify(
                 {"error": f"witness send not supported on {current_app.config['NETWORK']} network"}
@@ -105,18 +113,18 @@ def request_rgb_asset():  # pylint: disable=too-many-return-statements
         )
 
     # choose asset group
-    configured_assets = current_app.config["ASSETS"]
+    asset_groups = current_app.config["ASSET_GROUPS"]
     asset_group = data.get("asset_group")
-    if asset_group and asset_group not in configured_assets:
+    if asset_group and asset_group not in asset_groups:
         return jsonify({"error": "invalid asset group"}), 404
     asset = None
     if asset_group is None:
         # chose randomly from non-migration groups
         asset_group = random.choice(list(current_app.config["NON_MIGRATION_GROUPS"]))
-    asset = random.choice(list(configured_assets[asset_group]["assets"]))
+    asset = random.choice(asset_groups[asset_group].assets)
 
     # check if request is allowed
-    (allowed, reason) = _is_request_allowed(data["wallet_id"], asset_group)
+    (allowed, reason) = _get_request_eligibility(data["wallet_id"], [asset_group])[asset_group]
     if not allowed:
         return (
             jsonify(
@@ -129,71 +137,71 @@ def request_rgb_asset():  # pylint: disable=too-many-return-statements
         )
 
     # handle asset migration
-    non_mig_groups = current_app.config["NON_MIGRATION_GROUPS"]
-    is_mig_request = asset_group not in non_mig_groups
-    if is_mig_request:
+    if asset_groups[asset_group].migration:
         # wallet is entitled to a migration > detect the asset to be sent
-        mig_cache = current_app.config["ASSET_MIGRATION_CACHE"]
-        asset = mig_cache[asset_group].get(data["wallet_id"])
-        # remove the user (and possibly the whole group) from migration cache
-        del mig_cache[asset_group][data["wallet_id"]]
-        if not mig_cache[asset_group]:
-            del mig_cache[asset_group]
-
-    return _request_rgb_asset_core(data["wallet_id"], invoice, asset_group, asset, logger)
+        entitlement = MigrationEntitlement.query.filter_by(
+            asset_group=asset_group, wallet_id=data["wallet_id"]
+        ).one()
+        asset = next(
+            a for a in asset_groups[asset_group].assets if a["asset_id"] == entitlement.asset_id
+        )
 
+    return _request_rgb_asset_core(data["wallet_id"], recipient_data, asset_group, asset, logger)
 
-def _request_rgb_asset_core(wallet_id, invoice, asset_group, asset, logger):
-    # add request to db so max requests check works right away (no double req)
-    # pylint: disable=no-member
-    recipient_id = invoice.invoice_data().recipient_id
-    invoice_str = invoice.invoice_string()
-    db.session.add(Request(wallet_id, recipient_id, invoice_str, asset_group, None, None))
-    req = Request.query.filter(
-        Request.wallet_id == wallet_id,
-        Request.invoice == invoice_str,
-        Request.asset_group == asset_group,
-        Request.status == 10,
-    )
-    assert req.count() == 1
-    req_idx = req.first().idx
-    db.session.commit()
-    # pylint: enable=no-member
 
+def _request_rgb_asset_core(wallet_id, recipient_data, asset_group, asset, logger):
     # prepare asset data
-    rgb_asset, schema = get_rgb_asset(asset["asset_id"])
+    rgb_asset = get_rgb_asset(asset["asset_id"])
     if rgb_asset is None:
         return jsonify({"error": "internal error getting asset data"}), 500
     asset_data = {
         "asset_id": asset["asset_id"],
-        "schema": schema,
+        "schema": rgb_asset["schema"],
         "amount": asset["amount"],
-        "name": rgb_asset.name,
-        "precision": rgb_asset.precision,
-        "description": None,
-        "ticker": None,
+        "name": rgb_asset["name"],
+        "precision": rgb_asset["precision"],
+        "description": rgb_asset.get("description"),
+        "ticker": rgb_asset.get("ticker"),
     }
-    if hasattr(rgb_asset, "description"):
-        asset_data["description"] = rgb_asset.description
-    if hasattr(rgb_asset, "ticker"):
-        asset_data["ticker"] = rgb_asset.ticker
-
-    # update request on db: update status, set asset_id and amount
-    new_status = 20
-    dist_conf = current_app.config["ASSETS"][asset_group]["distribution"]
-    dist_mode = DistributionMode(dist_conf["mode"])
-    if dist_mode == DistributionMode.RANDOM:
-        new_status = 25
+
+    # requests are saved directly in their final status
+    status = 20
+    group = current_app.config["ASSET_GROUPS"][asset_group]
+    if group.mode == DistributionMode.RANDOM:
+        status = 25
+
+    # add claim and request to db in a single transaction
+    # the claim insert fails if the wallet has already requested from the group
     # pylint: disable=no-member
-    logger.debug(
-        "setting request %s: asset_id %s, amount %s, status %s",
-        req_idx,
+    try:
+        db.session.add(Claim(wallet_id, asset_group))
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return _already_requested(asset_group)
+    # claim the migration entitlement (fails if concurrently claimed)
+    if group.migration and not MigrationEntitlement.claim(asset_group, wallet_id):
+        db.session.rollback()
+        return _already_requested(asset_group)
+    req = Request(
+        wallet_id,
+        recipient_data["recipient_id"],
+        recipient_data["invoice"],
+        asset_group,
         asset["asset_id"],
         asset["amount"],
-        new_status,
+        status,
+        recipient_data["witness"],
+        list(recipient_data["transport_endpoints"]),
     )
-    Request.query.filter_by(idx=req_idx).update(
-        {"status": new_status, "asset_id": asset["asset_id"], "amount": asset["amount"]}
+    db.session.add(req)
+    db.session.flush()
+    logger.debug(
+        "adding request %s: asset_id %s, amount %s, status %s",
+        req.idx,
+        asset["asset_id"],
+        asset["amount"],
+        status,
     )
     db.session.commit()
     # pylint: enable=no-member
@@ -201,42 +209,93 @@ def _request_rgb_asset_core(wallet_id, invoice, asset_group, asset, logger):
     return jsonify(
         {
             "asset": asset_data,
-            "distribution": dist_conf,
+            "distribution": group.distribution,
         }
     )
 
 
-def _is_request_allowed(wallet_id, group_name):
-    """Return if a request should be allowed or denied."""
+def _already_requested(asset_group):
+    return (
+        jsonify(
+            {
+                "error": f"wallet has no right to request an asset from group {asset_group}",
+                "reason": REASON_MAP[DenyReason.ALREADY_REQUESTED.value],
+            }
+        ),
+        403,
+    )
+
+
+def _get_request_eligibility(wallet_id, group_names):
+    """Return if requests for the given groups should be allowed or denied.
+
+    Groups the wallet has already requested from (claims) are fetched with a
+    single indexed query, as are the migration groups with unclaimed
+    entitlements, along with whether the wallet holds one of them. The
+    distribution and migration rules are then applied in memory.
+
+    Returns a dict mapping each group name to an (allowed, reason) tuple.
+    """
+    # pylint: disable=no-member
+    requested_groups = set(
+        db.session.scalars(select(Claim.asset_group).where(Claim.wallet_id == wallet_id))
+    )
+    asset_groups = current_app.config["ASSET_GROUPS"]
+    mig_groups = [g for g in group_names if asset_groups[g].migration]
+    entitled_groups = set()
+    open_mig_groups = set()
+    if mig_groups:
+        # groups with entitlements still to be claimed, and if the wallet has one
+        rows = (
+            db.session.query(
+                MigrationEntitlement.asset_group,
+                func.max(case((MigrationEntitlement.wallet_id == wallet_id, 1), else_=0)),
+            )
+            .filter(
+                MigrationEntitlement.asset_group.in_(mig_groups),
+                MigrationEntitlement.claimed_at.is_(None),
+            )
+            .group_by(MigrationEntitlement.asset_group)
+        )
+        for group_name, entitled in rows:
+            open_mig_groups.add(group_name)
+            if entitled:
+                entitled_groups.add(group_name)
+    # pylint: enable=no-member
+    now = datetime.now()
+    eligibility = {}
+    for group_name in group_names:
+        mig_state = (group_name in open_mig_groups, group_name in entitled_groups)
+        eligibility[group_name] = _is_request_allowed(
+            asset_groups[group_name], group_name in requested_groups, now, mig_state
+        )
+    return eligibility
+
+
+def _is_request_allowed(group, already_requested, now, mig_state):
+    """Return if a request should be allowed or denied.
+
+    mig_state is a tuple of bools telling if the group has unclaimed migration
+    entitlements and if the wallet has one of them.
+    """
     # deny request if user has already placed a request for this group
-    reqs = Request.query.filter(
-        Request.wallet_id == wallet_id, Request.asset_group == group_name
-    ).count()
-    if reqs:
+    if already_requested:
         return (False, DenyReason.ALREADY_REQUESTED)
 
     # deny based on distribution mode
-    dist_conf = current_app.config["ASSETS"][group_name]["distribution"]
-    dist_mode = DistributionMode(dist_conf["mode"])
-    if dist_mode == DistributionMode.RANDOM:
-        req_win_open = dist_conf["random_params"]["request_window_open"]
-        req_win_close = dist_conf["random_params"]["request_window_close"]
-        date_format = current_app.config["DATE_FORMAT"]
-        req_win_open = datetime.strptime(req_win_open, date_format)
-        req_win_close = datetime.strptime(req_win_close, date_format)
-        now = datetime.now()
+    if group.mode == DistributionMode.RANDOM:
         # deny requests outside the configured request window
-        if now < req_win_open or now > req_win_close:
+        if now < group.request_window_open or now > group.request_window_close:
             return (False, DenyReason.OUSTIDE_REQUEST_WINDOW)
 
     # deny based on migration configuration and status
-    if group_name not in current_app.config["NON_MIGRATION_GROUPS"]:
-        mig_cache_group = current_app.config["ASSET_MIGRATION_CACHE"].get(group_name)
+    if group.migration:
+        (group_open, wallet_entitled) = mig_state
         # no requests allowed for completely migrated groups
-        if mig_cache_group is None:
+        if not group_open:
             return (False, DenyReason.MIGRATION_COMPLETE)
         # deny request if wallet ID is not in migration group
-        if mig_cache_group.get(wallet_id) is None:
+        if not wallet_entitled:
             return (False, DenyReason.NOT_IN_MIGRATION_LIST)
 
     # allow request
@@ -2,6 +2,8 @@
 
 from flask import Blueprint, current_app, jsonify, request
 
+from faucet_rgb.utils import invalidate_wallet_snapshot
+
 bp = Blueprint("reserve", __name__, url_prefix="/reserve")
 
 
@@ -30,4 +32,6 @@ def top_up_rgb():
         current_app.config["TRANSPORT_ENDPOINTS"],
         current_app.config["MIN_CONFIRMATIONS"],
     )
+    # the new receive has no asset, so the whole wallet needs to be listed again
+    invalidate_wallet_snapshot(current_app.config)
     return jsonify({"invoice": blind_data.invoice, "expiration": blind_data.expiration_timestamp})
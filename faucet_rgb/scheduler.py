@@ -1,79 +1,361 @@
 """Scheduler module."""
 
+import math
 import traceback
 
 import rgb_lib
 from flask import current_app
 from flask_apscheduler import APScheduler
+from sqlalchemy import func
 
 from faucet_rgb.utils import (
+    build_recipient,
     create_witness_utxos,
+    get_current_timestamp,
     get_logger,
     get_recipient,
     get_recipient_map_stats,
+    update_wallet_snapshot,
+    update_wallet_snapshot_assets,
 )
 
+from .batching import BatchContext, StaticPolicy
 from .database import Request, db
 
 scheduler = APScheduler()
 
+# send errors a single request can cause, any other error is about the wallet or its services
+REQUEST_ERRORS = (
+    rgb_lib.RgbLibError.InvalidInvoice,
+    rgb_lib.RgbLibError.InvalidRecipientId,
+    rgb_lib.RgbLibError.InvalidTransportEndpoint,
+    rgb_lib.RgbLibError.InvalidTransportEndpoints,
+    rgb_lib.RgbLibError.NoValidTransportEndpoint,
+    rgb_lib.RgbLibError.RecipientIdAlreadyUsed,
+    rgb_lib.RgbLibError.RecipientIdDuplicated,
+)
+
+
+def update_snapshot(cfg, transfers_changed=True, asset_ids=None):
+    """Update the wallet state snapshot, logging (and ignoring) any error.
+
+    Transfers are listed again only if transfers_changed is True. If asset_ids
+    is provided, only those assets (and unspents) are updated.
+    """
+    try:
+        if asset_ids is None:
+            update_wallet_snapshot(cfg, transfers_changed=transfers_changed)
+        else:
+            update_wallet_snapshot_assets(cfg, asset_ids)
+    except Exception as err:  # pylint: disable=broad-exception-caught
+        get_logger(__name__).error("error updating wallet snapshot: %s", repr(err))
+
+
+def get_pending_stats():
+    """Return stats on pending requests, per asset ID.
+
+    For each asset, the request count, the oldest timestamp and the lowest idx
+    (to break ties between requests with the same timestamp) are returned.
+    """
+    rows = (
+        db.session.query(  # pylint: disable=no-member
+            Request.asset_id,
+            func.count(Request.idx),
+            func.min(Request.timestamp),
+            func.min(Request.idx),
+        )
+        .filter(Request.status == 20)
+        .group_by(Request.asset_id)
+    )
+    return {
+        asset_id: {"count": count, "oldest": oldest, "first_idx": first_idx}
+        for asset_id, count, oldest, first_idx in rows
+    }
+
+
+def get_batch_limits(cfg, pending_stats, spare_utxos, now):
+    """Return the BatchLimits of each asset with pending requests.
+
+    Limits come from the batching policy of the asset's group, assets not in
+    any group (e.g. left by a migration) use the static policy.
+    """
+    context = BatchContext(cfg, now, len(spare_utxos))
+    policies = {
+        asset["asset_id"]: group.batching
+        for group in cfg["ASSET_GROUPS"].values()
+        for asset in group.assets
+    }
+    return {
+        asset_id: policies.get(asset_id, StaticPolicy()).get_limits(asset_id, stats, context)
+        for asset_id, stats in pending_stats.items()
+    }
+
+
+def get_asset_groups(asset_ids, unspents):
+    """Group the given assets by shared UTXOs.
+
+    Assets are in the same group if they (transitively) have allocations on
+    the same UTXOs, so their histories are already joined and sending them
+    together doesn't join any more of them. Groups keep the given asset order
+    and are returned in the order of their first asset.
+    """
+    parent = {}
+
+    def _find(asset_id):
+        root = parent.setdefault(asset_id, asset_id)
+        while root != parent[root]:
+            root = parent[root]
+        parent[asset_id] = root
+        return root
 
-def send_next_batch(spare_utxos):
+    for unspent in unspents:
+        unspent_asset_ids = [a.asset_id for a in unspent.rgb_allocations if a.asset_id]
+        for asset_id in unspent_asset_ids[1:]:
+            parent[_find(asset_id)] = _find(unspent_asset_ids[0])
+    groups = {}
+    for asset_id in asset_ids:
+        groups.setdefault(_find(asset_id), []).append(asset_id)
+    return list(groups.values())
+
+
+def plan_batches(cfg, pending_stats, unspents, limits):
+    """Return the batches to be sent, as dicts mapping asset IDs to recipient counts.
+
+    Assets are considered oldest pending request first and packed in batches
+    of at most MAX_BATCH_RECIPIENTS recipients, with up to the max_recipients
+    of their limits (see get_batch_limits) each. If an asset has more pending
+    requests, the oldest ones are sent.
+
+    Assets sharing UTXOs (see get_asset_groups) are planned in a single batch,
+    as a send spends the UTXOs and the other assets would then only be
+    spendable once it confirms. So each asset is sent at most once per round
+    and assets not fitting in their group's batch wait for the next round.
+
+    If the SINGLE_ASSET_SEND option is True, only assets sharing UTXOs are
+    packed in the same batch, so asset histories are kept separate, otherwise
+    the batches of different groups are packed together when they fit.
+    """
+    asset_ids = sorted(
+        pending_stats, key=lambda a: (pending_stats[a]["oldest"], pending_stats[a]["first_idx"])
+    )
+    max_recipients = cfg["MAX_BATCH_RECIPIENTS"]
+    batches = []
+    for group in get_asset_groups(asset_ids, unspents):
+        group_batch = {}
+        for asset_id in group:
+            count = min(
+                pending_stats[asset_id]["count"],
+                limits[asset_id].max_recipients,
+                max_recipients - sum(group_batch.values()),
+            )
+            if count <= 0:
+                break
+            group_batch[asset_id] = count
+        if (
+            not cfg["SINGLE_ASSET_SEND"]
+            and batches
+            and sum(batches[-1].values()) + sum(group_batch.values()) <= max_recipients
+        ):
+            batches[-1].update(group_batch)
+        else:
+            batches.append(group_batch)
+    return batches
+
+
+def is_batch_due(pending_stats, batch, limits, now):
+    """Return if the given batch has reached the thresholds of its assets' limits.
+
+    A batch is due if its assets have at least as many pending requests as
+    the lowest min_requests of their limits (see get_batch_limits) or if its
+    oldest request has been waiting for at least the lowest max_wait.
+    """
+    count = sum(pending_stats[asset_id]["count"] for asset_id in batch)
+    oldest = min(pending_stats[asset_id]["oldest"] for asset_id in batch)
+    min_requests = min(limits[asset_id].min_requests for asset_id in batch)
+    max_wait = min(limits[asset_id].max_wait for asset_id in batch)
+    return count >= min_requests or now - oldest >= max_wait
+
+
+def get_batch_requests(batch):
+    """Return the pending requests of the given batch, oldest first for each asset."""
+    reqs = []
+    for asset_id, count in batch.items():
+        reqs += (
+            Request.query.filter(Request.status == 20, Request.asset_id == asset_id)
+            .order_by(Request.idx)
+            .limit(count)
+            .all()
+        )
+    return reqs
+
+
+def send_next_batch(spare_utxos, reqs=None):
     """Send the next batch of queued requests.
 
-    If the SINGLE_ASSET_SEND option is True, only send a single asset per
-    batch, which should help to:
+    If the SINGLE_ASSET_SEND option is True, only send assets sharing UTXOs
+    in the same batch, which should help to:
     - keep asset histories separate
     - keep number of unspendable UTXOs low
+
+    If already loaded, requests to be sent can be provided via reqs, otherwise
+    the first batch planned by plan_batches is queried from the database.
+
+    Requests making the send fail are isolated, see _send_isolating.
+
+    Return True if (at least part of) the batch has been sent.
     """
     with scheduler.app.app_context():
         logger = get_logger(__name__)
         cfg = current_app.config
 
         # get requests to be processed
-        pending_reqs = Request.query.filter_by(status=20)
-        if cfg["SINGLE_ASSET_SEND"]:
-            # filter for asset ID of oldest request
-            oldest_req = Request.query.filter_by(status=20).first()
-            pending_reqs = Request.query.filter(
-                Request.status == 20, Request.asset_id == oldest_req.asset_id
-            )
-        reqs = pending_reqs.all()
-
-        # get asset set
-        asset_id_set = {r.asset_id for r in reqs}
-
-        # prepare recipient map
-        recipient_map = {}
-        for asset_id in asset_id_set:
-            # get list of recipients that need to receive this asset
-            recipient_list = []
-            for req in reqs:
-                if req.asset_id == asset_id:
-                    recipient = get_recipient(req.invoice, req.amount, cfg)
-                    recipient_list.append(recipient)
-            recipient_map[asset_id] = recipient_list
+        if reqs is None:
+            pending_stats = get_pending_stats()
+            limits = get_batch_limits(cfg, pending_stats, spare_utxos, get_current_timestamp())
+            unspents = cfg["WALLET"].list_unspents(None, False)
+            batches = plan_batches(cfg, pending_stats, unspents, limits)
+            reqs = get_batch_requests(batches[0]) if batches else []
+        if not reqs:
+            return False
+
+        # prepare recipients, setting requests they can't be built for as failed
+        recipients = _get_recipients(reqs, cfg)
+        reqs = [req for req in reqs if req.idx in recipients]
+        if not reqs:
+            return False
 
         # batch stats
-        stats = get_recipient_map_stats(recipient_map)
+        stats = get_recipient_map_stats(_get_recipient_map(reqs, recipients))
 
         # create additional UTXOs as needed
         created = create_witness_utxos(cfg, stats, spare_utxos)
         logger.info("%s additional UTXOs created", created)
 
         # try sending
-        _try_send(reqs, cfg, recipient_map, stats)
+        return _send_isolating(reqs, cfg, recipients) > 0
+
+
+def _get_recipients(reqs, cfg):
+    """Return the recipients of the given requests, by request idx.
+
+    Requests for which the recipient cannot be built are set as failed.
+    """
+    logger = get_logger(__name__)
+    recipients = {}
+    failed_idxs = []
+    for req in reqs:
+        try:
+            recipients[req.idx] = _get_request_recipient(req, cfg)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logger.error("Failed to build recipient for request %s: %s", req.idx, repr(err))
+            failed_idxs.append(req.idx)
+    if failed_idxs:
+        Request.update_status(failed_idxs, 20, 50)
+        db.session.commit()  # pylint: disable=no-member
+    return recipients
+
+
+def _get_recipient_map(reqs, recipients):
+    """Return the recipient map for the given requests, keeping their order."""
+    recipient_map = {}
+    for req in reqs:
+        recipient_map.setdefault(req.asset_id, []).append(recipients[req.idx])
+    return recipient_map
+
+
+def _get_request_recipient(req, cfg):
+    """Return the recipient for the given request.
+
+    The recipient is built from the data saved at ingestion, only falling back
+    to parsing the invoice for requests saved before it was stored.
+    """
+    if req.witness is None or req.transport_endpoints is None:
+        return get_recipient(req.invoice, req.amount, cfg)
+    return build_recipient(req.recipient_id, req.witness, req.transport_endpoints, req.amount, cfg)
+
+
+def _send_isolating(reqs, cfg, recipients):
+    """Send the given requests, isolating the ones making sends fail.
+
+    If a send fails with an error a request can cause (see REQUEST_ERRORS),
+    its requests are split in two halves, which are tried separately
+    (recursively), so a bad request (e.g. an invoice rgb-lib rejects) doesn't
+    keep the others from being sent. Any other error (e.g. not enough
+    bitcoins or an unreachable indexer) is not the requests' fault, so all of
+    them are left pending for the next run.
+
+    Once part of the requests has been sent, the remaining ones are left
+    pending for the next run, as the sent assets' UTXOs have been spent and
+    sends of the same assets would fail until the change confirms. Splitting
+    is also abandoned, leaving requests pending, if no send succeeds within
+    the first few attempts (about twice the splitting depth).
+
+    Requests failing alone are handled by _fail_requests.
+
+    Return the number of requests sent.
+    """
+    logger = get_logger(__name__)
+    max_failed_sends = 2 * math.ceil(math.log2(len(reqs))) + 1
+    sent = 0
+    failed_sends = 0
+    failed_reqs = []
+    parts = [reqs]
+    while parts:
+        if failed_sends >= max_failed_sends:
+            logger.warning("no send succeeded, leaving %s requests pending", len(reqs))
+            break
+        part = parts.pop(0)
+        recipient_map = _get_recipient_map(part, recipients)
+        error = _try_send(part, cfg, recipient_map, get_recipient_map_stats(recipient_map))
+        if error is None:
+            sent = len(part)
+            break
+        if not isinstance(error, REQUEST_ERRORS):
+            logger.warning("send failed, leaving %s requests pending", len(reqs))
+            break
+        failed_sends += 1
+        if len(part) > 1:
+            half = len(part) // 2
+            parts[:0] = [part[:half], part[half:]]
+        else:
+            failed_reqs.append(part[0])
+    _fail_requests(cfg, failed_reqs, logger)
+    return sent
+
+
+def _fail_requests(cfg, failed_reqs, logger):
+    """Set the given requests, which failed alone, as failed when they can't be sent.
+
+    Requests are set as failed only once they have failed alone in
+    MAX_SEND_ATTEMPTS runs, so a single transient error cannot fail a valid
+    request.
+    """
+    failures = dict(cfg["SEND_FAILURES"] or {})
+    failed_idxs = []
+    for req in failed_reqs:
+        failures[req.idx] = failures.get(req.idx, 0) + 1
+        if failures[req.idx] >= cfg["MAX_SEND_ATTEMPTS"]:
+            failed_idxs.append(req.idx)
+            del failures[req.idx]
+    cfg["SEND_FAILURES"] = failures
+    if failed_idxs:
+        logger.error("Setting requests %s as failed", failed_idxs)
+        Request.update_status(failed_idxs, 20, 50)
+        db.session.commit()  # pylint: disable=no-member
 
 
 def _try_send(reqs, cfg, recipient_map, stats):
-    """Try to send."""
+    """Try to send, returning None on success or the error making it fail.
+
+    If sending fails, requests are set back to "pending".
+    """
     with scheduler.app.app_context():
         logger = get_logger(__name__)
+        req_idxs = [req.idx for req in reqs]
         try:
             # set request status to "processing"
             logger.info("sending batch donation")
-            for req in reqs:
-                Request.query.filter_by(idx=req.idx).update({"status": 30})
+            Request.update_status(req_idxs, 20, 30)
             db.session.commit()  # pylint: disable=no-member
 
             # send assets
@@ -84,25 +366,44 @@ def _try_send(reqs, cfg, recipient_map, stats):
                 cfg["FEE_RATE"],
                 cfg["MIN_CONFIRMATIONS"],
             )
-            logger.info(
-                "batch donation (%s assets, %s recipients total, %s witnesses) sent with TXID: %s",
-                stats["assets"],
-                stats["recipients"],
-                stats["witnesses"],
-                txid,
-            )
-
-            # update status for served requests
-            for req in reqs:
-                Request.query.filter_by(idx=req.idx).update({"status": 40})
-            db.session.commit()  # pylint: disable=no-member
-        except rgb_lib.RgbLibError.InsufficientAllocationSlots:
+        except rgb_lib.RgbLibError.InsufficientAllocationSlots as err:
             logger.error("Failed to send: not enough allocation slots")
-        except rgb_lib.RgbLibError.InsufficientSpendableAssets:
+            return _reset_requests(req_idxs, err)
+        except rgb_lib.RgbLibError.InsufficientSpendableAssets as err:
             logger.error("Failed to send: not enough spendable assets")
-        except rgb_lib.RgbLibError.InsufficientTotalAssets:
+            return _reset_requests(req_idxs, err)
+        except rgb_lib.RgbLibError.InsufficientTotalAssets as err:
             logger.error("Failed to send: not enough total assets")
-        except Exception:  # pylint: disable=broad-exception-caught
+            return _reset_requests(req_idxs, err)
+        except Exception as err:  # pylint: disable=broad-exception-caught
             # log any other error, including traceback
             logger.error("Failed to send: unexpected")
             logger.error(traceback.format_exc())
+            return _reset_requests(req_idxs, err)
+        logger.info(
+            "batch donation (%s assets, %s recipients total, %s witnesses) sent with TXID: %s",
+            stats["assets"],
+            stats["recipients"],
+            stats["witnesses"],
+            txid,
+        )
+
+        # update status for served requests
+        Request.update_status(req_idxs, 30, 40)
+        db.session.commit()  # pylint: disable=no-member
+        if cfg["SEND_FAILURES"]:
+            cfg["SEND_FAILURES"] = {
+                idx: count for idx, count in cfg["SEND_FAILURES"].items() if idx not in req_idxs
+            }
+
+        # the full snapshot is left to the refresh_transfers task
+        update_snapshot(cfg, asset_ids=list(recipient_map))
+        return None
+
+
+def _reset_requests(req_idxs, error):
+    """Set the given requests back to "pending" after a failed send, returning the error."""
+    db.session.rollback()  # pylint: disable=no-member
+    Request.update_status(req_idxs, 30, 20)
+    db.session.commit()  # pylint: disable=no-member
+    return error
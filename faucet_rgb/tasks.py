@@ -6,36 +6,51 @@ from datetime import datetime
 
 import rgb_lib
 from flask import current_app
+from sqlalchemy import func, select
 
 from faucet_rgb.settings import DistributionMode
 
-from .database import Request, db
-from .scheduler import scheduler, send_next_batch
-from .utils import get_current_timestamp, get_logger, get_spare_utxos
+from .database import Request, RequestArchive, db
+from .scheduler import (
+    get_batch_limits,
+    get_batch_requests,
+    get_pending_stats,
+    is_batch_due,
+    plan_batches,
+    scheduler,
+    send_next_batch,
+    update_snapshot,
+)
+from .utils import (
+    get_current_timestamp,
+    get_logger,
+    get_pending_asset_ids,
+    get_spare_utxos,
+    has_pending_without_asset,
+    refresh_wallet,
+)
 
 
 def batch_donation():
     """
     Batch donation task.
 
-    First, refresh currently pending transfers so they can settle.
-    Then, check if the minimum amount of recipients or the maximum waiting time
-    have been reached. If so, send the next batch of asset donations.
+    Plan the batches of pending requests (see plan_batches) and send, in this
+    run, up to MAX_SENDS_PER_TICK of those which have reached the minimum
+    amount of recipients or the maximum waiting time, as set by the batching
+    policy of their asset groups (see the batching module).
 
-    If the SINGLE_ASSET_SEND option is True, only consider a single asset. See
-    the send_next_batch function for details.
+    The wallet is not refreshed here, sends use the state left by the last run
+    of the refresh_transfers task, so they don't wait for a full refresh.
+
+    If the SINGLE_ASSET_SEND option is True, only assets sharing UTXOs are
+    sent together. See the send_next_batch function for details.
     """
     with scheduler.app.app_context():
         # get configuration variables
         logger = get_logger(__name__)
         cfg = current_app.config
 
-        # refresh pending transfers
-        try:
-            cfg["WALLET"].refresh(cfg["ONLINE"], None, [])
-        except Exception as err:  # pylint: disable=broad-exception-caught
-            logger.error("error refreshing transfers: %s", repr(err))
-
         # reset status for requests left being processed to "pending"
         Request.query.filter_by(status=30).update({"status": 20})
         db.session.commit()  # pylint: disable=no-member
@@ -52,27 +67,105 @@ def batch_donation():
                     cfg["FEE_RATE"],
                 )
                 logger.info("%s UTXOs created", created)
+                if created:
+                    update_snapshot(cfg, transfers_changed=False)
+                    spare_utxos = get_spare_utxos(cfg)
 
-        # checks
-        request_thresh_reached = False
-        enough_time_elapsed = False
-        pending_requests = Request.query.filter_by(status=20)
-        if pending_requests.count() and cfg["SINGLE_ASSET_SEND"]:
-            oldest_req = Request.query.filter_by(status=20).first()
-            pending_requests = Request.query.filter(
-                Request.status == 20, Request.asset_id == oldest_req.asset_id
-            )
-        # request count against configured threshold
-        if pending_requests.count() >= cfg["MIN_REQUESTS"]:
-            request_thresh_reached = True
-        # elapsed time since oldest request
-        if pending_requests.count():
-            oldest_timestamp = pending_requests.first().timestamp
-            if get_current_timestamp() - oldest_timestamp >= cfg["MAX_WAIT_MINUTES"] * 60:
-                enough_time_elapsed = True
+        _send_due_batches(cfg, spare_utxos, logger)
+
+
+def _send_due_batches(cfg, spare_utxos, logger):
+    """Send the planned batches reaching their thresholds."""
+    pending_stats = get_pending_stats()
+    now = get_current_timestamp()
+    limits = get_batch_limits(cfg, pending_stats, spare_utxos, now)
+    unspents = cfg["WALLET"].list_unspents(None, False)
+    batches = [
+        batch
+        for batch in plan_batches(cfg, pending_stats, unspents, limits)
+        if is_batch_due(pending_stats, batch, limits, now)
+    ]
+    sent = []
+    for i, batch in enumerate(batches[: cfg["MAX_SENDS_PER_TICK"]]):
+        # previous sends have used spare UTXOs
+        if i > 0:
+            spare_utxos = get_spare_utxos(cfg)
+        if send_next_batch(spare_utxos, get_batch_requests(batch)):
+            sent.append(batch)
+    if len(sent) > 1:
+        # sending a batch per run, each batch would have waited a run more
+        interval = cfg["SCHEDULER_INTERVAL"]
+        recipients = [sum(batch.values()) for batch in sent]
+        saved = sum(i * interval * count for i, count in enumerate(recipients))
+        logger.info(
+            "%s batches (%s recipients) sent in one run, queueing delay saved: "
+            "%.0f s per recipient on average, up to %s s",
+            len(sent),
+            sum(recipients),
+            saved / sum(recipients),
+            (len(sent) - 1) * interval,
+        )
+
+
+def refresh_transfers():
+    """
+    Wallet refresh task.
+
+    Refresh transfers so pending ones can progress and settle, then update the
+    wallet state snapshot.
+
+    Assets with pending transfers are refreshed, one by one, on every run
+    (every REFRESH_INTERVAL seconds). The whole wallet, including idle assets,
+    is refreshed on a slower cadence: each full refresh reporting no changes
+    doubles the wait before the next one, up to REFRESH_MAX_INTERVAL seconds.
+    Without an up-to-date snapshot, or with pending transfers not connected to
+    an asset (e.g. RGB top-ups), the whole wallet is refreshed on every run.
+    """
+    with scheduler.app.app_context():
+        # get configuration variables
+        logger = get_logger(__name__)
+        cfg = current_app.config
+
+        now = get_current_timestamp()
+        backoff = cfg["REFRESH_BACKOFF"] or {"delay": cfg["REFRESH_INTERVAL"], "next": 0}
+        pending_asset_ids = get_pending_asset_ids(cfg["WALLET_SNAPSHOT"])
+        # transfers with no asset can only be refreshed along with the whole wallet
+        full = (
+            pending_asset_ids is None
+            or has_pending_without_asset(cfg["WALLET_SNAPSHOT"])
+            or now >= backoff["next"]
+        )
+        if not full and not pending_asset_ids:
+            return
 
-        if request_thresh_reached or enough_time_elapsed:
-            send_next_batch(spare_utxos)
+        if not full:
+            changed = _refresh_assets(cfg, pending_asset_ids, logger)
+            update_snapshot(cfg, changed)
+            return
+
+        try:
+            changed = refresh_wallet(cfg)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logger.error("error refreshing transfers: %s", repr(err))
+            changed = True
+        update_snapshot(cfg, changed)
+        if changed or has_pending_without_asset(cfg["WALLET_SNAPSHOT"]):
+            delay = cfg["REFRESH_INTERVAL"]
+        else:
+            delay = min(backoff["delay"] * 2, cfg["REFRESH_MAX_INTERVAL"])
+        cfg["REFRESH_BACKOFF"] = {"delay": delay, "next": now + delay}
+
+
+def _refresh_assets(cfg, asset_ids, logger):
+    """Refresh transfers of the given assets, returning if any has changed."""
+    changed = False
+    for asset_id in asset_ids:
+        try:
+            changed |= refresh_wallet(cfg, asset_id)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logger.error("error refreshing transfers for asset %s: %s", asset_id, repr(err))
+            changed = True
+    return changed
 
 
 def random_distribution():
@@ -82,39 +175,39 @@ def random_distribution():
     Update requests for random distribution asset groups:
     - choose random requests from received ones and set them as pending
     - set remaining requests as unmet
+
+    Selection uses the RANDOM_SEED configuration, if set, so it's reproducible.
     """
     with scheduler.app.app_context():
         # get configuration variables
         logger = get_logger(__name__)
         cfg = current_app.config
 
+        rng = random.Random(cfg["RANDOM_SEED"])
         now = datetime.now()
-        for group, val in current_app.config["ASSETS"].items():
+        for group in cfg["ASSET_GROUPS"].values():
             # skip if not random mode or request window has not closed yet
-            dist_conf = current_app.config["ASSETS"][group].get("distribution")
-            dist_mode = DistributionMode(dist_conf["mode"])
-            if dist_mode != DistributionMode.RANDOM:
+            if group.mode != DistributionMode.RANDOM:
                 continue
-            req_win_close = dist_conf["random_params"]["request_window_close"]
-            req_win_close = datetime.strptime(req_win_close, cfg["DATE_FORMAT"])
-            if now < req_win_close:
+            if now < group.request_window_close:
                 continue
 
-            for asset in val["assets"]:
+            for asset in group.assets:
                 asset_id = asset["asset_id"]
                 # get waiting requests for asset
-                reqs = Request.query.filter_by(asset_id=asset_id, status=25).all()
+                waiting_idxs = [
+                    row.idx
+                    for row in db.session.query(Request.idx)  # pylint: disable=no-member
+                    .filter_by(asset_id=asset_id, status=25)
+                    .order_by(Request.idx)
+                ]
+                if not waiting_idxs:
+                    continue
                 # get asset future balance (what we expect to be able to send)
                 balance = cfg["WALLET"].get_asset_balance(asset_id).future
-                count = 0
                 # choose random requests and set them to pending status
-                while balance > 0 and reqs:
-                    req = random.choice(reqs)
-                    Request.query.filter_by(idx=req.idx).update({"status": 20})
-                    db.session.commit()  # pylint: disable=no-member
-                    reqs.remove(req)
-                    balance -= 1
-                    count += 1
+                chosen_idxs = rng.sample(waiting_idxs, min(max(balance, 0), len(waiting_idxs)))
+                count = Request.update_status(chosen_idxs, 25, 20)
                 if count > 0:
                     logger.info("set %s requests as pending for asset %s", count, asset_id)
                 # set remaining requests to unmet status
@@ -124,3 +217,77 @@ def random_distribution():
                 if reqs_unmet > 0:
                     logger.info("set %s requests as unmet for asset %s", reqs_unmet, asset_id)
                 db.session.commit()  # pylint: disable=no-member
+
+
+def sweep_stale_requests():
+    """
+    Stale requests sweeper task.
+
+    Delete requests left in status "new" for more than a couple minutes. At
+    most SWEEP_BATCH_SIZE requests are deleted per transaction, so the database
+    lock is only held briefly.
+    """
+    with scheduler.app.app_context():
+        # get configuration variables
+        logger = get_logger(__name__)
+        cfg = current_app.config
+
+        time_thresh = get_current_timestamp() - 120
+        deleted = 0
+        while True:
+            stale_idxs = (
+                select(Request.idx)
+                .where(Request.status == 10, Request.timestamp < time_thresh)
+                .limit(cfg["SWEEP_BATCH_SIZE"])
+            )
+            count = Request.query.filter(Request.idx.in_(stale_idxs)).delete(
+                synchronize_session=False
+            )
+            db.session.commit()  # pylint: disable=no-member
+            deleted += count
+            if count < cfg["SWEEP_BATCH_SIZE"]:
+                break
+        if deleted > 0:
+            logger.info("deleted %s stale requests", deleted)
+
+
+def archive_requests():
+    """
+    Request archiver task.
+
+    Move served, unmet and failed requests older than ARCHIVE_AFTER_DAYS to
+    the archive table, so the request table only holds recent requests. At
+    most ARCHIVE_BATCH_SIZE requests are moved per transaction.
+    """
+    with scheduler.app.app_context():
+        # get configuration variables
+        logger = get_logger(__name__)
+        cfg = current_app.config
+
+        time_thresh = get_current_timestamp() - cfg["ARCHIVE_AFTER_DAYS"] * 86400
+        # never archive the last request, as SQLite would then reuse its idx
+        max_idx = db.session.query(func.max(Request.idx)).scalar()  # pylint: disable=no-member
+        if max_idx is None:
+            return
+        archived = 0
+        while True:
+            idxs = [
+                row.idx
+                for row in db.session.query(Request.idx)  # pylint: disable=no-member
+                .filter(
+                    Request.status.in_((40, 45, 50)),
+                    Request.timestamp < time_thresh,
+                    Request.idx < max_idx,
+                )
+                .order_by(Request.idx)
+                .limit(cfg["ARCHIVE_BATCH_SIZE"])
+            ]
+            if not idxs:
+                break
+            RequestArchive.archive(idxs)
+            db.session.commit()  # pylint: disable=no-member
+            archived += len(idxs)
+            if len(idxs) < cfg["ARCHIVE_BATCH_SIZE"]:
+                break
+        if archived > 0:
+            logger.info("archived %s requests", archived)
@@ -1,11 +1,20 @@
 """Utils module."""
 
+import heapq
 import logging
+import threading
 import time
 
 import rgb_lib
 from flask import current_app
 
+from .wallet import get_unspent_list
+
+# transfer statuses waiting for the counterparty or the blockchain
+PENDING_TRANSFER_STATUSES = ("WAITING_COUNTERPARTY", "WAITING_CONFIRMATIONS")
+
+_REFRESH_STATS_LOCK = threading.Lock()
+
 
 def get_current_timestamp():
     """Return the current timestamp in seconds as a (rounded) integer."""
@@ -20,59 +29,329 @@ def get_logger(name):
 
 
 def get_rgb_asset(asset_id):
-    """Return the RGB asset with the given ID and its schema, if found."""
-    wallet = current_app.config["WALLET"]
-    assets = wallet.list_assets([])
+    """Return the metadata for the RGB asset with the given ID, if found.
+
+    Metadata is served from the asset metadata cache, which is only updated
+    (listing assets from the wallet) if the asset is not found there.
+    """
+    cache = current_app.config["ASSET_METADATA_CACHE"]
+    if asset_id not in cache:
+        assets = current_app.config["WALLET"].list_assets([])
+        cache = update_asset_cache(current_app.config, assets)
+    return cache.get(asset_id)
+
+
+def get_asset_metadata(asset):
+    """Return the metadata (fields that never change) of the given asset."""
+    metadata = {
+        "name": asset.name,
+        "precision": asset.precision,
+    }
+    if hasattr(asset, "ticker"):
+        metadata["ticker"] = asset.ticker
+    if hasattr(asset, "description"):
+        metadata["description"] = asset.description
+    if hasattr(asset, "data_paths"):
+        for data_path in asset.data_paths:
+            path_list = metadata.setdefault("data_paths", [])
+            attachment_id = data_path.file_path.split("/")[-2]
+            path_list.append(
+                {
+                    "mime-type": data_path.mime,
+                    "attachment_id": attachment_id,
+                }
+            )
+    return metadata
+
+
+def update_asset_cache(config, assets):
+    """Update the asset metadata cache from the provided assets.
+
+    The cache is rebuilt only if the set of asset IDs has changed, as asset
+    metadata never changes. The cache is replaced, never modified in place,
+    so readers holding it aren't affected by updates.
+
+    Args:
+        config: the app configuration, holding the cache
+        assets: assets as returned by the rgb-lib list_assets API
+    """
+    cache = config["ASSET_METADATA_CACHE"]
+    asset_ids = {asset.asset_id for asset in assets.nia + assets.cfa}
+    if asset_ids == cache.keys():
+        return cache
+    new_cache = {}
     for schema in ("nia", "cfa"):
         for asset in getattr(assets, schema):
-            if asset.asset_id == asset_id:
-                return asset, schema.upper()
-    return None, None
+            new_cache[asset.asset_id] = get_asset_metadata(asset) | {"schema": schema.upper()}
+    config["ASSET_METADATA_CACHE"] = new_cache
+    return new_cache
+
 
+def get_asset_dict(assets, metadata_cache=None):
+    """Return a dict of the available assets.
 
-def get_asset_dict(assets):
-    """Return a dict of the available assets."""
+    If a metadata cache is provided, asset metadata is taken from it when
+    available, otherwise it is read from the assets.
+    """
     asset_dict = {}
     for asset in assets:
-        asset_dict[asset.asset_id] = {
-            "balance": {
-                "settled": asset.balance.settled,
-                "future": asset.balance.future,
-                "spendable": asset.balance.spendable,
-            },
-            "name": asset.name,
-            "precision": asset.precision,
-        }
-        if hasattr(asset, "ticker"):
-            asset_dict[asset.asset_id]["ticker"] = asset.ticker
-        if hasattr(asset, "description"):
-            asset_dict[asset.asset_id]["description"] = asset.description
-        if hasattr(asset, "data_paths"):
-            for data_path in asset.data_paths:
-                path_list = asset_dict[asset.asset_id].setdefault("data_paths", [])
-                attachment_id = data_path.file_path.split("/")[-2]
-                path_list.append(
-                    {
-                        "mime-type": data_path.mime,
-                        "attachment_id": attachment_id,
-                    }
-                )
+        metadata = None
+        if metadata_cache is not None:
+            metadata = metadata_cache.get(asset.asset_id)
+        if metadata is None:
+            metadata = get_asset_metadata(asset)
+        asset_dict[asset.asset_id] = {"balance": get_balance_dict(asset.balance)}
+        asset_dict[asset.asset_id].update({k: v for k, v in metadata.items() if k != "schema"})
     return asset_dict
 
 
+def get_balance_dict(balance):
+    """Return a dict with the data of the given asset balance."""
+    return {
+        "settled": balance.settled,
+        "future": balance.future,
+        "spendable": balance.spendable,
+    }
+
+
+def get_transfer_dict(transfer, asset_id):
+    """Return a dict with the data of the given transfer of the given asset."""
+    ttes = [
+        {
+            "endpoint": tte.endpoint,
+            "transport_type": tte.transport_type.name,
+            "used": tte.used,
+        }
+        for tte in transfer.transport_endpoints
+    ]
+    return {
+        "idx": transfer.idx,
+        "asset_id": asset_id,
+        "status": transfer.status.name,
+        "amount": transfer.amount,
+        "kind": transfer.kind.name,
+        "txid": transfer.txid,
+        "recipient_id": transfer.recipient_id,
+        "transfer_transport_endpoints": ttes,
+    }
+
+
+def get_transfer_index(wallet, asset_ids):
+    """Return the transfers of the given assets, indexed by asset ID and status.
+
+    Assets keep the given order and, for each asset and status, transfers keep
+    the wallet's order. Assets are listed one by one, as the rgb-lib wallet
+    handle serializes calls anyway.
+    """
+    index = {}
+    for asset_id in asset_ids:
+        by_status = index[asset_id] = {}
+        for transfer in wallet.list_transfers(asset_id):
+            by_status.setdefault(transfer.status.name, []).append(
+                get_transfer_dict(transfer, asset_id)
+            )
+    return index
+
+
+def count_pending_without_asset(wallet):
+    """Return the number of pending transfers not yet connected to an asset.
+
+    These are receives with no asset ID (e.g. RGB top-ups), which rgb-lib lists
+    separately from the ones of any asset.
+    """
+    return sum(
+        1
+        for transfer in wallet.list_transfers(None)
+        if transfer.status.name in PENDING_TRANSFER_STATUSES
+    )
+
+
+def filter_transfers(index, statuses, asset_id=None):
+    """Yield the indexed transfers in the given statuses.
+
+    If an asset ID is provided, only transfers of that asset are yielded.
+    Transfers are yielded by asset and, for each asset, in the wallet's order.
+    """
+    asset_ids = index if asset_id is None else [asset_id]
+    for aid in asset_ids:
+        by_status = index.get(aid, {})
+        yield from heapq.merge(
+            *(by_status.get(status, []) for status in statuses), key=lambda t: t["idx"]
+        )
+
+
+def get_pending_asset_ids(snapshot):
+    """Return the IDs of the assets with pending transfers in the given snapshot.
+
+    Without an up-to-date snapshot, pending transfers are unknown and None is
+    returned.
+    """
+    if snapshot is None or snapshot["stale"]:
+        return None
+    return [
+        asset_id
+        for asset_id, by_status in snapshot["transfers"].items()
+        if any(status in by_status for status in PENDING_TRANSFER_STATUSES)
+    ]
+
+
+def has_pending_without_asset(snapshot):
+    """Return if the given snapshot has pending transfers not connected to an asset."""
+    return snapshot is not None and not snapshot["stale"] and snapshot["pending_without_asset"] > 0
+
+
+def refresh_wallet(config, asset_id=None):
+    """Refresh transfers of the given asset (or the whole wallet), recording stats.
+
+    Refresh count, changes, errors and duration are recorded per asset (or for
+    the whole wallet) in the REFRESH_STATS configuration variable. Return the
+    rgb-lib refresh result (if any transfer has changed).
+    """
+    start = time.perf_counter()
+    changed = None
+    try:
+        changed = config["WALLET"].refresh(config["ONLINE"], asset_id, [])
+        return changed
+    finally:
+        _record_refresh(config, asset_id, time.perf_counter() - start, changed)
+
+
+def _record_refresh(config, asset_id, duration, changed):
+    """Record a refresh in the refresh stats.
+
+    Refreshes run from both the scheduler and the control APIs, so updates
+    are serialized by a lock.
+    """
+    with _REFRESH_STATS_LOCK:
+        stats = config.get("REFRESH_STATS") or {"wallet": None, "assets": {}}
+        if asset_id is None:
+            previous = stats["wallet"]
+        else:
+            previous = stats["assets"].get(asset_id)
+        if previous is None:
+            previous = {"count": 0, "changed": 0, "errors": 0, "total_seconds": 0.0}
+        record = {
+            "count": previous["count"] + 1,
+            "changed": previous["changed"] + int(bool(changed)),
+            "errors": previous["errors"] + int(changed is None),
+            "total_seconds": previous["total_seconds"] + duration,
+            "last_seconds": duration,
+            "last_timestamp": get_current_timestamp(),
+        }
+        if asset_id is None:
+            config["REFRESH_STATS"] = stats | {"wallet": record}
+        else:
+            config["REFRESH_STATS"] = stats | {"assets": stats["assets"] | {asset_id: record}}
+
+
+def update_wallet_snapshot(config, online=None, transfers_changed=True):
+    """Take a snapshot of the wallet state and store it in the configuration.
+
+    The snapshot holds assets (with balances), unspents and transfers, read
+    from the wallet as of its last refresh, along with the number of pending
+    transfers with no asset. Unspents are synced first only if online is
+    provided.
+
+    Transfers are only listed again if transfers_changed is True (e.g. the
+    refresh reported changes), the set of assets has changed or the previous
+    snapshot has been invalidated. Each listing gets a new generation number,
+    so clients can tell if the transfers have changed.
+    """
+    wallet = config["WALLET"]
+    asset_list = wallet.list_assets([])
+    metadata_cache = update_asset_cache(config, asset_list)
+    assets = asset_list.nia + asset_list.cfa
+    asset_ids = [asset.asset_id for asset in assets]
+    previous = config.get("WALLET_SNAPSHOT")
+    if (
+        transfers_changed
+        or previous is None
+        or previous["stale"]
+        or list(previous["transfers"]) != asset_ids
+    ):
+        transfers = get_transfer_index(wallet, asset_ids)
+        generation = 1 if previous is None else previous["generation"] + 1
+    else:
+        transfers = previous["transfers"]
+        generation = previous["generation"]
+    snapshot = {
+        "timestamp": get_current_timestamp(),
+        "assets": get_asset_dict(assets, metadata_cache),
+        "unspents": get_unspent_list(wallet, online),
+        "transfers": transfers,
+        "pending_without_asset": count_pending_without_asset(wallet),
+        "generation": generation,
+        "stale": False,
+    }
+    config["WALLET_SNAPSHOT"] = snapshot
+    return snapshot
+
+
+def update_wallet_snapshot_assets(config, asset_ids):
+    """Update the wallet state snapshot after transfers of the given assets.
+
+    Only the given assets' balances and transfers, and unspents, are read
+    again, so the update doesn't depend on the number of assets in the
+    wallet. A missing or stale snapshot is left as it is, for the next full
+    update.
+    """
+    previous = config.get("WALLET_SNAPSHOT")
+    if previous is None or previous["stale"]:
+        return previous
+    if any(asset_id not in previous["assets"] for asset_id in asset_ids):
+        invalidate_wallet_snapshot(config)
+        return config["WALLET_SNAPSHOT"]
+    wallet = config["WALLET"]
+    assets = dict(previous["assets"])
+    for asset_id in asset_ids:
+        balance = get_balance_dict(wallet.get_asset_balance(asset_id))
+        assets[asset_id] = assets[asset_id] | {"balance": balance}
+    snapshot = previous | {
+        "timestamp": get_current_timestamp(),
+        "assets": assets,
+        "unspents": get_unspent_list(wallet, None),
+        "transfers": previous["transfers"] | get_transfer_index(wallet, asset_ids),
+        "generation": previous["generation"] + 1,
+    }
+    config["WALLET_SNAPSHOT"] = snapshot
+    return snapshot
+
+
+def get_wallet_snapshot(config, fresh=False):
+    """Return the wallet state snapshot.
+
+    If fresh is True, no snapshot is available or it has been invalidated, the
+    wallet is refreshed and a new snapshot is taken.
+    """
+    snapshot = config.get("WALLET_SNAPSHOT")
+    if fresh or snapshot is None or snapshot["stale"]:
+        changed = refresh_wallet(config)
+        snapshot = update_wallet_snapshot(config, config["ONLINE"], changed)
+    return snapshot
+
+
+def invalidate_wallet_snapshot(config):
+    """Mark the wallet state snapshot as stale, so the next read takes a new one."""
+    snapshot = config.get("WALLET_SNAPSHOT")
+    if snapshot is not None:
+        config["WALLET_SNAPSHOT"] = snapshot | {"stale": True}
+
+
 def get_recipient(invoice, amount, cfg):
     """Return a recipient for the given invoice."""
     invoice_data = rgb_lib.Invoice(invoice).invoice_data()
     recipient_id = invoice_data.recipient_id
     # detect if blinded UTXO or script (witness tx)
-    blinded_utxo = is_blinded_utxo(recipient_id)
-    # create Recipient
-    if blinded_utxo:
-        recipient = rgb_lib.Recipient(recipient_id, None, amount, invoice_data.transport_endpoints)
-    else:
+    witness = not is_blinded_utxo(recipient_id)
+    return build_recipient(recipient_id, witness, invoice_data.transport_endpoints, amount, cfg)
+
+
+def build_recipient(recipient_id, witness, transport_endpoints, amount, cfg):
+    """Return a recipient from already-parsed invoice data."""
+    if witness:
         script_data = rgb_lib.ScriptData(recipient_id, cfg["AMOUNT_SAT"], None)
-        recipient = rgb_lib.Recipient(None, script_data, amount, invoice_data.transport_endpoints)
-    return recipient
+        return rgb_lib.Recipient(None, script_data, amount, transport_endpoints)
+    return rgb_lib.Recipient(recipient_id, None, amount, transport_endpoints)
 
 
 def get_spare_utxos(config):
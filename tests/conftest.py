@@ -8,7 +8,7 @@ import pytest
 from apscheduler.schedulers import SchedulerNotRunningError
 
 from faucet_rgb.scheduler import scheduler
-from tests.utils import create_test_app, get_test_datadir, prepare_assets
+from tests.utils import create_test_app, get_test_datadir, prepare_assets, reset_test_database
 
 
 def _default_app_prep(app):
@@ -36,6 +36,7 @@ def get_app():
         if os.path.exists(datadir):
             shutil.rmtree(datadir)
         os.makedirs(datadir, exist_ok=True)
+        reset_test_database()
 
         return create_test_app(custom_app_prep=custom_app_prep)
 
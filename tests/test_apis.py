@@ -1,5 +1,8 @@
 """Tests for APIs."""
 
+import csv
+import io
+import json
 import random
 import time
 import uuid
@@ -7,7 +10,8 @@ from datetime import datetime, timedelta
 
 import rgb_lib
 
-from faucet_rgb import Request, scheduler
+from faucet_rgb import Request, export, receive, scheduler
+from faucet_rgb.database import Claim, MigrationEntitlement, db
 from faucet_rgb.settings import DistributionMode
 from faucet_rgb.utils.wallet import get_sha256_hex
 from tests.utils import (
@@ -67,7 +71,8 @@ def test_control_assets(get_app):
     res = client.get(api, headers=USER_HEADERS)
     assert res.status_code == 401
 
-    # success
+    # success (pause the scheduler so it doesn't update the snapshot)
+    scheduler.pause()
     res = client.get(api, headers=OPERATOR_HEADERS)
     assert res.status_code == 200
     assert "assets" in res.json
@@ -77,6 +82,15 @@ def test_control_assets(get_app):
     assert "name" in res.json["assets"][first_asset]
     assert "precision" in res.json["assets"][first_asset]
 
+    # served from the wallet state snapshot, unless fresh data is requested
+    res_cached = client.get(api, headers=OPERATOR_HEADERS)
+    assert res_cached.json["timestamp"] == res.json["timestamp"]
+    time.sleep(1)
+    res_fresh = client.get(f"{api}?fresh=1", headers=OPERATOR_HEADERS)
+    assert res_fresh.status_code == 200
+    assert res_fresh.json["timestamp"] > res.json["timestamp"]
+    assert res_fresh.json["assets"] == res.json["assets"]
+
 
 def test_control_delete(get_app):
     """Test /control/delete endpoint."""
@@ -122,6 +136,55 @@ def test_control_delete(get_app):
     assert len(transfers_failed) == 0
 
 
+def test_control_export(get_app):
+    """Test /control/export endpoint."""
+    api = "/control/export"
+    app = get_app()
+    client = app.test_client()
+
+    # auth failure
+    res = client.get(api, headers=USER_HEADERS)
+    assert res.status_code == 401
+
+    # no requests, only the header
+    resp = client.get(api, headers=OPERATOR_HEADERS)
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/csv"
+    rows = list(csv.reader(io.StringIO(resp.get_data(as_text=True))))
+    assert rows == [export.EXPORT_COLUMNS]
+
+    users = prepare_user_wallets(app, 2)
+    scheduler.pause()
+    add_fake_request(app, users[0], "group_1", 20, amount=1)
+    add_fake_request(app, users[1], "group_2", 40, amount=2)
+
+    # all requests, in idx order
+    resp = client.get(api, headers=OPERATOR_HEADERS)
+    assert resp.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+    assert [r["amount"] for r in rows] == ["1", "2"]
+    assert json.loads(rows[0]["transport_endpoints"])
+
+    # filters
+    resp = client.get(f"{api}?status=40&asset_group=group_2", headers=OPERATOR_HEADERS)
+    rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+    assert [r["amount"] for r in rows] == ["2"]
+    resp = client.get(f"{api}?asset_group=group_1&status=40", headers=OPERATOR_HEADERS)
+    rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+    assert not rows
+
+    # archived requests
+    resp = client.get(f"{api}?archived=1", headers=OPERATOR_HEADERS)
+    rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+    assert not rows
+
+    # invalid parameters
+    resp = client.get(f"{api}?format=xml", headers=OPERATOR_HEADERS)
+    assert resp.status_code == 400
+    resp = client.get(f"{api}?status=served", headers=OPERATOR_HEADERS)
+    assert resp.status_code == 400
+
+
 def test_control_fail(get_app):
     """Test /control/fail endpoint."""
     api = "/control/fail"
@@ -210,7 +273,7 @@ def test_control_refresh(get_app):
     refresh_and_check_settled(client, app.config, asset_id)
 
 
-def test_control_requests(get_app):  # pylint: disable=too-many-statements
+def test_control_requests(get_app):  # pylint: disable=too-many-locals,too-many-statements
     """Test /control/requests endpoint."""
     api = "/control/requests"
     app = get_app()
@@ -340,6 +403,38 @@ def test_control_requests(get_app):  # pylint: disable=too-many-statements
     assert request["status"] == status
     assert request["amount"] == 1
 
+    # keyset pagination
+    idxs = sorted(r.idx for r in all_reqs)
+    resp = client.get(f"{api}?status=20&limit=1", headers=OPERATOR_HEADERS)
+    assert resp.status_code == 200
+    assert [r["idx"] for r in resp.json["requests"]] == [idxs[1]]
+    assert resp.json["has_more"]
+    resp = client.get(f"{api}?status=20&limit=1&before={idxs[1]}", headers=OPERATOR_HEADERS)
+    assert resp.status_code == 200
+    assert [r["idx"] for r in resp.json["requests"]] == [idxs[0]]
+    assert not resp.json["has_more"]
+    resp = client.get(f"{api}?since=0&after={idxs[0]}", headers=OPERATOR_HEADERS)
+    assert resp.status_code == 200
+    assert [r["idx"] for r in resp.json["requests"]] == idxs[1:]
+    resp = client.get(f"{api}?limit=0", headers=OPERATOR_HEADERS)
+    assert resp.status_code == 400
+
+    # time range
+    max_timestamp = max(r.timestamp for r in all_reqs)
+    resp = client.get(f"{api}?until={max_timestamp + 1}", headers=OPERATOR_HEADERS)
+    assert resp.status_code == 200
+    assert len(resp.json["requests"]) == 3
+    resp = client.get(f"{api}?since={max_timestamp + 1}", headers=OPERATOR_HEADERS)
+    assert resp.status_code == 200
+    assert not resp.json["requests"]
+
+    # NDJSON streaming
+    resp = client.get(f"{api}?since=0&format=ndjson", headers=OPERATOR_HEADERS)
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/x-ndjson"
+    lines = resp.get_data(as_text=True).splitlines()
+    assert [json.loads(line)["idx"] for line in lines] == list(reversed(idxs))
+
 
 def test_control_transfers(get_app):  # pylint: disable=too-many-statements
     """Test /control/transfers endpoint."""
@@ -370,15 +465,51 @@ def test_control_transfers(get_app):  # pylint: disable=too-many-statements
         assert transfer["kind"] == "ISSUANCE"
         assert transfer["status"] == "SETTLED"
 
+    # pagination
+    resp_page = client.get(
+        f"{api}?status=SETTLED&limit=1",
+        headers=OPERATOR_HEADERS,
+    )
+    assert resp_page.status_code == 200
+    assert resp_page.json["transfers"] == resp.json["transfers"][:1]
+    assert resp_page.json["has_more"] is True
+    resp_page = client.get(
+        f"{api}?status=SETTLED&limit=1&offset=1",
+        headers=OPERATOR_HEADERS,
+    )
+    assert resp_page.json["transfers"] == resp.json["transfers"][1:]
+    assert resp_page.json["has_more"] is False
+    resp_page = client.get(
+        f"{api}?limit=0",
+        headers=OPERATOR_HEADERS,
+    )
+    assert resp_page.status_code == 400
+
+    # filter by asset ID
+    asset_id = resp.json["transfers"][0]["asset_id"]
+    resp_asset = client.get(
+        f"{api}?status=SETTLED&asset_id={asset_id}",
+        headers=OPERATOR_HEADERS,
+    )
+    assert resp_asset.status_code == 200
+    assert resp_asset.json["transfers"] == resp.json["transfers"][:1]
+    resp_asset = client.get(
+        f"{api}?asset_id=unknown",
+        headers=OPERATOR_HEADERS,
+    )
+    assert resp_asset.status_code == 404
+    generation = resp.json["generation"]
+
     # 1 pending (WAITING_COUNTERPARTY + WAITING_CONFIRMATIONS) transfers
     user = prepare_user_wallets(app, 1)[0]
     check_receive_asset(app, user, None, 200)
     wait_sched_process_pending(app)
     resp = client.get(
-        api,
+        f"{api}?fresh=1",
         headers=OPERATOR_HEADERS,
     )
     assert resp.status_code == 200
+    assert resp.json["generation"] > generation
     assert len(resp.json["transfers"]) == 1
     transfer = next(iter(resp.json["transfers"]))
     assert "amount" in transfer
@@ -422,8 +553,9 @@ def test_control_transfers(get_app):  # pylint: disable=too-many-statements
     )
     print("waiting for the transfer to expire...")
     time.sleep(2)
+    # wallet changed outside the scheduler, refresh the snapshot
     resp = client.get(
-        f"{api}?status=WAITING_COUNTERPARTY",
+        f"{api}?status=WAITING_COUNTERPARTY&fresh=1",
         headers=OPERATOR_HEADERS,
     )
     assert resp.status_code == 200
@@ -549,6 +681,36 @@ def test_receive_asset(get_app):
     assert resp.json["error"] == "invalid asset group"
 
 
+def test_receive_asset_concurrent(get_app, monkeypatch):
+    """Test /receive/asset denies a request racing another one from the same wallet."""
+    app = get_app()
+    client = app.test_client()
+
+    scheduler.pause()
+
+    user = prepare_user_wallets(app, 1)[0]
+    wallet_id = get_sha256_hex(user["xpub"])
+
+    # a concurrent request has claimed the groups after the eligibility check
+    with app.app_context():
+        for group_name in app.config["ASSET_GROUPS"]:
+            db.session.add(Claim(wallet_id, group_name))
+        db.session.commit()
+    monkeypatch.setattr(
+        receive,
+        "_get_request_eligibility",
+        lambda _wallet_id, group_names: {name: (True, None) for name in group_names},
+    )
+
+    resp = receive_asset(client, user["xpub"], create_and_blind(app.config, user))
+    assert resp.status_code == 403
+    assert resp.json["reason"] == "already requested from group"
+    with app.app_context():
+        assert Request.query.count() == 0
+        assert MigrationEntitlement.query.count() == 0
+        assert Claim.query.count() == len(app.config["ASSET_GROUPS"])
+
+
 def test_receive_asset_witness(get_app):
     """Test /receive/asset endpoint with a witness transfer."""
     app = get_app()
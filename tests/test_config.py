@@ -69,6 +69,17 @@ def _app_prep_cfg_random_bad_req_win(app):
     return app
 
 
+def _app_prep_cfg_batching_min_requests(app):
+    """Prepare app with a batching min_requests larger than the max batch size."""
+    app = prepare_assets(app, "group_1")
+    app.config["ASSETS"]["group_1"]["batching"] = {
+        "policy": "adaptive",
+        "min_requests": 20,
+        "max_batch_recipients": 10,
+    }
+    return app
+
+
 def _app_preparation_0conf(app):
     """Prepare app for the first launch."""
     app = prepare_assets(app, "group_1")
@@ -146,3 +157,12 @@ def test_cfg_random_bad_req_win(get_app):
     except exceptions.ConfigurationError as err:
         assert len(err.errors) == 1
         assert "not after open" in err.errors[0]
+
+
+def test_cfg_batching_min_requests(get_app):
+    """Test configuration with a batching min_requests larger than max_batch_recipients."""
+    try:
+        get_app(_app_prep_cfg_batching_min_requests)
+    except exceptions.ConfigurationError as err:
+        assert len(err.errors) == 1
+        assert "larger than max_batch_recipients" in err.errors[0]
@@ -10,6 +10,7 @@ import time
 import pytest
 
 from faucet_rgb import Request
+from faucet_rgb.database import MigrationEntitlement
 from faucet_rgb.scheduler import scheduler
 from faucet_rgb.utils import get_logger
 from tests.utils import (
@@ -73,6 +74,12 @@ def _get_app_preparation_2(old_asset_config):
     return _app_preparation_2
 
 
+def _unclaimed_entitlements(app, group):
+    """Return the number of unclaimed migration entitlements for a group."""
+    with app.app_context():
+        return MigrationEntitlement.query.filter_by(asset_group=group, claimed_at=None).count()
+
+
 def _assure_no_pending_request(app):
     """Wait until all requests are served.
 
@@ -129,7 +136,8 @@ def test_migration(get_app):  # pylint: disable=too-many-statements
     """
 
     app = get_app(_app_preparation_1)
-    assert not app.config["ASSET_MIGRATION_CACHE"]
+    with app.app_context():
+        assert not MigrationEntitlement.query.count()
     assert app.config["NON_MIGRATION_GROUPS"] == {"group_1", "group_2"}
 
     # pause the scheduler so it doesn't process pending requests
@@ -159,8 +167,8 @@ def test_migration(get_app):  # pylint: disable=too-many-statements
     old_asset_config = app.config["ASSETS"]
     app_preparation_2 = _get_app_preparation_2(old_asset_config)
     app = create_test_app(custom_app_prep=app_preparation_2)
-    assert app.config["ASSET_MIGRATION_CACHE"].get("group_1") is not None
-    assert app.config["ASSET_MIGRATION_CACHE"].get("group_2") is not None
+    assert _unclaimed_entitlements(app, "group_1") == 2
+    assert _unclaimed_entitlements(app, "group_2") == 1
     assert app.config["NON_MIGRATION_GROUPS"] == {"group_dummy"}
 
     new_group_1_asset_ids = [i["asset_id"] for i in app.config["ASSETS"]["group_1"]["assets"]]
@@ -232,8 +240,9 @@ def test_migration(get_app):  # pylint: disable=too-many-statements
     while scheduler.running:
         time.sleep(1)
     app = create_test_app(config=app.config)
-    assert app.config["ASSET_MIGRATION_CACHE"].get("group_1") is not None
-    assert app.config["ASSET_MIGRATION_CACHE"].get("group_2") is not None
+    # claimed entitlements are persisted across restarts
+    assert _unclaimed_entitlements(app, "group_1") == 0
+    assert _unclaimed_entitlements(app, "group_2") == 0
     assert app.config["NON_MIGRATION_GROUPS"] == {"group_dummy"}
 
     # user 0 has now migrated group_1 > 0 requests left
@@ -266,7 +275,6 @@ def test_migration(get_app):  # pylint: disable=too-many-statements
     config["ASSETS"].pop("group_2")
     config["ASSET_MIGRATION_MAP"] = None
     app = create_test_app(config=config)
-    assert not app.config["ASSET_MIGRATION_CACHE"]
     assert app.config["NON_MIGRATION_GROUPS"] == {"group_dummy"}
 
     # user 0 has already requested from group_dummy > 0 requests left
@@ -3,13 +3,16 @@
 import time
 from datetime import datetime, timedelta
 
-from faucet_rgb import Request
+from faucet_rgb import Request, scheduler
+from faucet_rgb.database import db
 from faucet_rgb.receive import REASON_MAP
 from faucet_rgb.settings import DistributionMode
+from faucet_rgb.tasks import random_distribution
 from faucet_rgb.utils.wallet import get_sha256_hex
 from tests.utils import (
     OPERATOR_HEADERS,
     USER_HEADERS,
+    add_fake_request,
     create_and_blind,
     issue_single_asset_with_supply,
     prepare_assets,
@@ -52,6 +55,21 @@ def _app_prep_random_multiple_assets(app):
     return app
 
 
+def _app_prep_random_closed_window(app):
+    """Prepare app to test random distribution with an already closed request window."""
+    now = datetime.now()
+    dist_mode = random_dist_mode(app.config, now - timedelta(minutes=2), now - timedelta(minutes=1))
+    app = prepare_assets(
+        app,
+        "group_1",
+        dist_mode=dist_mode,
+        issue_func=_issue_single_asset_2,
+        send_amount=1,
+    )
+    app.config["RANDOM_SEED"] = 42
+    return app
+
+
 def _issue_single_asset_2(app):
     return issue_single_asset_with_supply(app, 2)
 
@@ -259,3 +277,29 @@ def test_random_multiple_assets(get_app):  # pylint: disable=too-many-locals
             result["unmet"] += 1
     assert result["served"] == asset_balance * 2
     assert result["unmet"] == extra_requests * 2
+
+
+def test_random_seed(get_app):
+    """Test random selection is reproducible with a configured seed."""
+    app = get_app(_app_prep_random_closed_window)
+
+    scheduler.pause()
+
+    # more waiting requests than available assets
+    users = prepare_user_wallets(app, 6)
+    for user in users:
+        add_fake_request(app, user, "group_1", 25)
+
+    # run the selection twice on the same waiting requests
+    winners = []
+    for _ in range(2):
+        with app.app_context():
+            Request.query.update({"status": 25})
+            db.session.commit()
+        random_distribution()
+        with app.app_context():
+            winners.append(sorted(r.idx for r in Request.query.filter_by(status=20)))
+            assert Request.query.filter_by(status=45).count() == len(users) - 2
+
+    assert len(winners[0]) == 2
+    assert winners[0] == winners[1]
@@ -2,13 +2,30 @@
 
 import time
 
+import rgb_lib
+
 from faucet_rgb import scheduler
-from faucet_rgb.database import Request
-from faucet_rgb.scheduler import send_next_batch
-from faucet_rgb.utils import get_spare_available, get_spare_utxos
+from faucet_rgb.batching import AdaptivePolicy, BatchContext, BatchLimits, StaticPolicy
+from faucet_rgb.database import Request, RequestArchive, db
+from faucet_rgb.scheduler import get_batch_limits, get_pending_stats, send_next_batch
+from faucet_rgb.tasks import (
+    archive_requests,
+    batch_donation,
+    refresh_transfers,
+    sweep_stale_requests,
+)
+from faucet_rgb.utils import (
+    get_current_timestamp,
+    get_spare_available,
+    get_spare_utxos,
+    get_wallet_snapshot,
+)
 from faucet_rgb.utils.wallet import get_sha256_hex
 from tests.utils import (
+    OPERATOR_HEADERS,
     USER_HEADERS,
+    add_fake_request,
+    check_requests_left,
     issue_single_asset_with_supply,
     prepare_assets,
     prepare_user_wallets,
@@ -27,6 +44,40 @@ def _app_prep_single_asset_false(app):
     return app
 
 
+def _app_prep_single_asset_true(app):
+    """Prepare app to test SINGLE_ASSET_SEND set to True with 2 asset groups."""
+    app = prepare_assets(app, "group_1")
+    app = prepare_assets(app, "group_2")
+    app.config["SINGLE_ASSET_SEND"] = True
+    return app
+
+
+def _app_prep_max_batch_recipients(app):
+    """Prepare app to test a backlog larger than MAX_BATCH_RECIPIENTS."""
+    app = prepare_assets(app, "group_1")
+    app.config["MAX_BATCH_RECIPIENTS"] = 2
+    return app
+
+
+def _app_prep_adaptive_batching(app):
+    """Prepare app to test the adaptive batching policy on the first asset group."""
+    app = prepare_assets(app, "group_1")
+    app = prepare_assets(app, "group_2")
+    app.config["ASSETS"]["group_1"]["batching"] = {
+        "policy": "adaptive",
+        "min_requests": 3,
+        "max_wait_minutes": 60,
+    }
+    return app
+
+
+def _app_prep_archive(app):
+    """Prepare app to test request archiving."""
+    app = prepare_assets(app, "group_1")
+    app.config["ARCHIVE_AFTER_DAYS"] = 30
+    return app
+
+
 def _app_prep_create_witness_utxos(app):
     """Prepare app to test UTXO creation for witness batch transfers."""
     app = prepare_assets(app, "group_1", issue_func=_issue_single_asset_1000, send_amount=1)
@@ -150,3 +201,336 @@ def test_single_asset_false(get_app):
     with app.app_context():
         assert Request.query.count() == 2
         assert all(r.status == 40 for r in Request.query.all())
+
+
+def test_single_asset_multiple_sends(get_app):
+    """Test assets on separate UTXOs are sent in separate batches, in the same run."""
+    app = get_app(_app_prep_single_asset_true)
+    client = app.test_client()
+
+    scheduler.pause()
+
+    users = prepare_user_wallets(app, 2)
+
+    # request 2 different assets
+    for idx, user in enumerate(users):
+        invoice = witness(app.config, user)
+        resp = client.post(
+            "/receive/asset",
+            json={
+                "wallet_id": get_sha256_hex(user["xpub"]),
+                "invoice": invoice,
+                "asset_group": f"group_{idx+1}",
+            },
+            headers=USER_HEADERS,
+        )
+        assert resp.status_code == 200
+
+    # manually trigger the batch donation task once
+    batch_donation()
+
+    # check both assets have been sent, in different transactions
+    with app.app_context():
+        assert all(r.status == 40 for r in Request.query.all())
+        asset_ids = {r.asset_id for r in Request.query.all()}
+    assert len(asset_ids) == 2
+    txids = set()
+    for asset_id in asset_ids:
+        transfers = app.config["WALLET"].list_transfers(asset_id)
+        txids.update(t.txid for t in transfers if t.kind == rgb_lib.TransferKind.SEND)
+    assert len(txids) == 2
+
+
+def test_max_batch_recipients(get_app):
+    """Test a backlog larger than MAX_BATCH_RECIPIENTS is sent once per run."""
+    app = get_app(_app_prep_max_batch_recipients)
+
+    scheduler.pause()
+
+    users = prepare_user_wallets(app, 3)
+    for user in users:
+        add_fake_request(app, user, "group_1", 20)
+
+    # manually trigger the batch donation task once
+    batch_donation()
+
+    # check only the oldest requests have been sent, in a single transaction
+    with app.app_context():
+        reqs = Request.query.order_by(Request.idx).all()
+        assert [r.status for r in reqs] == [40, 40, 20]
+        asset_id = reqs[0].asset_id
+    transfers = app.config["WALLET"].list_transfers(asset_id)
+    assert len({t.txid for t in transfers if t.kind == rgb_lib.TransferKind.SEND}) == 1
+
+
+def test_failing_request_isolated(get_app):
+    """Test a request making the send fail doesn't keep the others from being sent."""
+    app = get_app(_app_prep_single_asset_false)
+    app.config["MAX_SEND_ATTEMPTS"] = 2
+
+    scheduler.pause()
+
+    users = prepare_user_wallets(app, 3)
+    for user in users[:2]:
+        add_fake_request(app, user, "group_1", 20)
+
+    # add a request with the same recipient ID of the first one
+    with app.app_context():
+        req = Request.query.order_by(Request.idx).first()
+        dup_req = Request(
+            users[2]["xpub"],
+            req.recipient_id,
+            req.invoice,
+            req.asset_group,
+            req.asset_id,
+            req.amount,
+            20,
+            False,
+            req.transport_endpoints,
+        )
+        db.session.add(dup_req)
+        db.session.commit()
+        dup_idx = dup_req.idx
+
+    def _send_and_get_statuses():
+        send_next_batch(get_spare_utxos(app.config))
+        with app.app_context():
+            return [r.status for r in Request.query.order_by(Request.idx)]
+
+    # the batch is split and its first half is sent, the rest is left for the next run
+    assert _send_and_get_statuses() == [40, 20, 20]
+    # the duplicate request keeps failing, the other one is sent
+    assert _send_and_get_statuses() == [40, 40, 20]
+    # the duplicate request fails alone, until MAX_SEND_ATTEMPTS is reached
+    assert _send_and_get_statuses() == [40, 40, 20]
+    assert _send_and_get_statuses() == [40, 40, 50]
+    with app.app_context():
+        assert Request.query.filter_by(status=50).one().idx == dup_idx
+
+
+def test_send_updates_snapshot_assets(get_app):
+    """Test a send only updates the sent assets (and unspents) in the wallet state snapshot."""
+    app = get_app(_app_prep_single_asset_false)
+
+    scheduler.pause()
+
+    user = prepare_user_wallets(app, 1)[0]
+    add_fake_request(app, user, "group_1", 20)
+    with app.app_context():
+        asset_id = Request.query.one().asset_id
+    snapshot = get_wallet_snapshot(app.config, fresh=True)
+
+    assert send_next_batch(get_spare_utxos(app.config))
+
+    new_snapshot = app.config["WALLET_SNAPSHOT"]
+    assert new_snapshot["generation"] == snapshot["generation"] + 1
+    pending = new_snapshot["transfers"][asset_id]["WAITING_COUNTERPARTY"]
+    assert [t["kind"] for t in pending] == ["SEND"]
+    balance = new_snapshot["assets"][asset_id]["balance"]
+    assert balance["future"] < snapshot["assets"][asset_id]["balance"]["future"]
+    for other_id, transfers in snapshot["transfers"].items():
+        if other_id != asset_id:
+            assert new_snapshot["transfers"][other_id] is transfers
+            assert new_snapshot["assets"][other_id] is snapshot["assets"][other_id]
+
+
+def test_wallet_error_keeps_requests_pending(get_app, monkeypatch):
+    """Test an error not caused by the requests leaves them all pending."""
+    app = get_app(_app_prep_single_asset_false)
+    app.config["MAX_SEND_ATTEMPTS"] = 2
+
+    scheduler.pause()
+
+    users = prepare_user_wallets(app, 3)
+    for user in users:
+        add_fake_request(app, user, "group_1", 20)
+
+    # make the faucet run out of bitcoins
+    sends = []
+
+    def _send(*_args):
+        sends.append(None)
+        raise rgb_lib.RgbLibError.InsufficientBitcoins(1000, 0)
+
+    monkeypatch.setattr(app.config["WALLET"], "send", _send)
+
+    # each run tries a single send, with no splitting, and no request is set as failed
+    runs = app.config["MAX_SEND_ATTEMPTS"] + 1
+    for _ in range(runs):
+        assert not send_next_batch(get_spare_utxos(app.config))
+    assert len(sends) == runs
+    with app.app_context():
+        assert [r.status for r in Request.query.order_by(Request.idx)] == [20, 20, 20]
+    assert not app.config["SEND_FAILURES"]
+
+
+def test_adaptive_batching(get_app):
+    """Test asset groups are sent according to their batching policy."""
+    app = get_app(_app_prep_adaptive_batching)
+    assert isinstance(app.config["ASSET_GROUPS"]["group_1"].batching, AdaptivePolicy)
+    assert isinstance(app.config["ASSET_GROUPS"]["group_2"].batching, StaticPolicy)
+
+    scheduler.pause()
+
+    users = prepare_user_wallets(app, 4)
+    for user in users[:2]:
+        add_fake_request(app, user, "group_1", 20)
+    add_fake_request(app, users[2], "group_2", 20)
+
+    # the static group is sent, the adaptive one waits for its trigger
+    batch_donation()
+    with app.app_context():
+        assert {r.asset_group: r.status for r in Request.query.all()} == {
+            "group_1": 20,
+            "group_2": 40,
+        }
+        # 2 arrivals in the last 60 minutes, 1 expected in the 30 minutes target wait,
+        # raised to min_requests, max batch size twice the trigger
+        now = get_current_timestamp()
+        spare_utxos = [None] * app.config["SPARE_UTXO_THRESH"]
+        pending_stats = get_pending_stats()
+        limits = get_batch_limits(app.config, pending_stats, spare_utxos, now)
+        assert list(limits.values()) == [BatchLimits(3, 3600, 6)]
+        asset_id = list(limits)[0]
+        # a backlog is drained within the target wait (360 sends at SCHEDULER_INTERVAL 5)
+        policy = app.config["ASSET_GROUPS"]["group_1"].batching
+        context = BatchContext(app.config, now, len(spare_utxos))
+        backlog = pending_stats[asset_id] | {"count": 7200}
+        assert policy.get_limits(asset_id, backlog, context) == BatchLimits(3, 3600, 20)
+        # with scarce spare UTXOs only full batches are sent before max wait
+        context = BatchContext(app.config, now, 0)
+        limit = policy.get_limits(asset_id, pending_stats[asset_id], context)
+        assert limit == BatchLimits(100, 3600, 100)
+
+    # the adaptive group is sent once its trigger is reached
+    add_fake_request(app, users[3], "group_1", 20)
+    batch_donation()
+    with app.app_context():
+        assert all(r.status == 40 for r in Request.query.all())
+
+
+def test_archive_requests(get_app):
+    """Test archiving of old served and unmet requests."""
+    app = get_app(_app_prep_archive)
+
+    scheduler.pause()
+
+    users = prepare_user_wallets(app, 4)
+
+    # old served and unmet requests, old pending one and a recent served one
+    add_fake_request(app, users[0], "group_1", 40, hash_wallet_id=True)
+    add_fake_request(app, users[1], "group_1", 45, hash_wallet_id=True)
+    add_fake_request(app, users[2], "group_1", 20, hash_wallet_id=True)
+    with app.app_context():
+        old_timestamp = get_current_timestamp() - (app.config["ARCHIVE_AFTER_DAYS"] + 1) * 86400
+        Request.query.update({"timestamp": old_timestamp})
+        db.session.commit()
+    add_fake_request(app, users[3], "group_1", 40, hash_wallet_id=True)
+
+    archive_requests()
+
+    # only old requests in a final status have been archived
+    with app.app_context():
+        assert sorted(r.status for r in Request.query.all()) == [20, 40]
+        assert sorted(r.status for r in RequestArchive.query.all()) == [40, 45]
+
+    # archived requests still count as already requested
+    for user in users:
+        check_requests_left(app, user["xpub"], {"group_1": 0})
+
+
+def test_sweep_stale_requests(get_app):
+    """Test deletion of requests left in status "new"."""
+    app = get_app()
+
+    scheduler.pause()
+
+    users = prepare_user_wallets(app, 3)
+
+    # a stale new request, a recent new one and an old pending one
+    add_fake_request(app, users[0], "group_1", 10, hash_wallet_id=True)
+    add_fake_request(app, users[1], "group_1", 20, hash_wallet_id=True)
+    with app.app_context():
+        Request.query.update({"timestamp": get_current_timestamp() - 300})
+        db.session.commit()
+    add_fake_request(app, users[2], "group_1", 10, hash_wallet_id=True)
+
+    sweep_stale_requests()
+
+    # only the stale new request has been deleted
+    with app.app_context():
+        assert sorted(r.status for r in Request.query.all()) == [10, 20]
+        assert Request.query.filter_by(wallet_id=get_sha256_hex(users[0]["xpub"])).count() == 0
+
+
+def test_refresh_transfers_without_asset(get_app):
+    """Test pending transfers with no asset (RGB top-ups) refresh the whole wallet."""
+    app = get_app()
+    client = app.test_client()
+
+    scheduler.pause()
+
+    # no pending transfers: unchanged refreshes back off
+    refresh_transfers()
+    app.config["REFRESH_BACKOFF"]["next"] = 0
+    refresh_transfers()
+    assert app.config["REFRESH_BACKOFF"]["delay"] > app.config["REFRESH_INTERVAL"]
+
+    # pending RGB top-up: the whole wallet is refreshed on every run, with no backoff
+    resp = client.get("/reserve/top_up_rgb", headers=OPERATOR_HEADERS)
+    assert resp.status_code == 200
+    assert app.config["WALLET_SNAPSHOT"]["stale"]
+    for _ in range(2):
+        wallet_count = app.config["REFRESH_STATS"]["wallet"]["count"]
+        refresh_transfers()
+        assert app.config["REFRESH_STATS"]["wallet"]["count"] == wallet_count + 1
+        assert app.config["REFRESH_BACKOFF"]["delay"] == app.config["REFRESH_INTERVAL"]
+        assert app.config["WALLET_SNAPSHOT"]["pending_without_asset"] == 1
+
+
+def test_refresh_transfers(get_app):
+    """Test wallet refresh planning, depending on pending transfers."""
+    app = get_app()
+    client = app.test_client()
+
+    scheduler.pause()
+
+    # no pending transfers: unchanged refreshes back off
+    refresh_transfers()
+    delay = app.config["REFRESH_BACKOFF"]["delay"]
+    app.config["REFRESH_BACKOFF"]["next"] = 0
+    refresh_transfers()
+    backoff = app.config["REFRESH_BACKOFF"]
+    assert backoff["delay"] == 2 * delay
+    snapshot = app.config["WALLET_SNAPSHOT"]
+    # next refresh not due yet: skipped
+    refresh_transfers()
+    assert app.config["REFRESH_BACKOFF"] is backoff
+    assert app.config["WALLET_SNAPSHOT"] is snapshot
+
+    # pending transfer: its asset is refreshed on every run
+    asset_id = app.config["WALLET"].list_assets([]).nia[0].asset_id
+    app.config["WALLET"].blind_receive(
+        asset_id, None, None, app.config["TRANSPORT_ENDPOINTS"], app.config["MIN_CONFIRMATIONS"]
+    )
+    resp = client.get(
+        "/control/transfers?status=WAITING_COUNTERPARTY&fresh=1", headers=OPERATOR_HEADERS
+    )
+    assert len(resp.json["transfers"]) == 1
+    wallet_stats = app.config["REFRESH_STATS"]["wallet"]
+    for count in (1, 2):
+        snapshot = app.config["WALLET_SNAPSHOT"]
+        refresh_transfers()
+        assert app.config["WALLET_SNAPSHOT"] is not snapshot
+        assert app.config["REFRESH_STATS"]["assets"][asset_id]["count"] == count
+    # the whole wallet is still refreshed on the slower cadence
+    assert app.config["REFRESH_BACKOFF"] is backoff
+    assert app.config["REFRESH_STATS"]["wallet"] == wallet_stats
+
+    # refresh instrumentation
+    resp = client.get("/control/refresh_stats", headers=OPERATOR_HEADERS)
+    assert resp.status_code == 200
+    assert resp.json["pending_assets"] == [asset_id]
+    assert resp.json["next_wallet_refresh"] == backoff["next"]
+    assert resp.json["assets"][asset_id]["count"] == 2
+    assert resp.json["wallet"]["count"] == wallet_stats["count"]
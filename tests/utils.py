@@ -12,9 +12,10 @@ from datetime import datetime
 import rgb_lib
 from flask import Flask
 from flask_apscheduler import STATE_RUNNING
+from sqlalchemy import MetaData, create_engine
 
 from faucet_rgb import create_app, scheduler, utils
-from faucet_rgb.database import Request, db
+from faucet_rgb.database import Claim, Request, db
 from faucet_rgb.settings import Config
 from faucet_rgb.utils.wallet import get_sha256_hex, wallet_data_from_config
 
@@ -39,6 +40,8 @@ OPERATOR_HEADERS = {"x-api-key": Config.API_KEY_OPERATOR}
 BAD_HEADERS = {"x-api-key": "wrongkey"}
 ISSUE_AMOUNT = 1000
 SEND_AMOUNT = 100
+# database to run the tests against (e.g. PostgreSQL), the default is SQLite
+DATABASE_URI = os.environ.get("FAUCET_TEST_DATABASE_URI")
 
 
 def get_test_name():
@@ -54,6 +57,21 @@ def get_test_datadir():
     return os.path.join(test_data, get_test_name())
 
 
+def reset_test_database():
+    """Drop all tables from the configured test database, if any.
+
+    SQLite databases are inside the test data directory, which is removed
+    before each test, other databases are shared so they need to be reset.
+    """
+    if DATABASE_URI is None:
+        return
+    engine = create_engine(DATABASE_URI)
+    metadata = MetaData()
+    metadata.reflect(engine)
+    metadata.drop_all(engine)
+    engine.dispose()
+
+
 def fund_address(addr):
     """A sendtoaddress rpc for the bitcoin node."""
     subprocess.run(
@@ -205,7 +223,11 @@ def witness(config, user):
 def add_fake_request(  # pylint: disable=too-many-arguments
     app, user, asset_group, status, amount=None, asset_id=None, hash_wallet_id=False
 ):
-    """Add a request to DB to simulate a previous request."""
+    """Add a request to DB to simulate a previous request.
+
+    As in production, the wallet's claim on the group is only added for requests
+    past status 10 (new).
+    """
     if amount is None:
         amount = app.config["ASSETS"][asset_group]["assets"][0]["amount"]
     if asset_id is None:
@@ -224,21 +246,13 @@ def add_fake_request(  # pylint: disable=too-many-arguments
                 asset_group,
                 asset_id,
                 amount,
+                status,
+                False,
+                invoice_data.transport_endpoints,
             )
         )
-        req = Request.query.filter(
-            Request.wallet_id == wallet_id,
-            Request.invoice == invoice,
-            Request.asset_group == asset_group,
-            Request.status == 10,
-        )
-        assert req.count() == 1
-        req_idx = req.first().idx
-        Request.query.filter_by(idx=req_idx).update(
-            {
-                "status": status,
-            }
-        )
+        if status != 10:
+            db.session.add(Claim(wallet_id, asset_group))
         db.session.commit()
 
 
@@ -351,6 +365,7 @@ def _get_test_base_app():
     app.config.from_object(Config)
     app.config["NAME"] = name
     app.config["DATA_DIR"] = get_test_datadir()
+    app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
 
     # network settings
     app.config["ELECTRUM_URL"] = ELECTRUM_URL
@@ -360,6 +375,7 @@ def _get_test_base_app():
     # scheduler settings (fast processing)
     app.config["MIN_REQUESTS"] = 1
     app.config["SCHEDULER_INTERVAL"] = 5
+    app.config["REFRESH_INTERVAL"] = 5
 
     return app
 